@@ -0,0 +1,152 @@
+"""
+Wall time, request counts and peak memory of the HTTP integrations against local stand-ins
+"""
+from argparse import ArgumentParser
+from json import dumps
+from os import environ, wait4
+from pathlib import Path
+from subprocess import DEVNULL, PIPE, Popen
+from sys import executable
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from mock_services import MockState, start
+
+ROOT = Path(__file__).resolve().parents[1]
+TOOLS = ('datadog', 'zendesk', 'watcher', 'slack_channels', 'slack_emails')
+
+
+def get_arguments():
+    """
+    Parse call arguments
+
+    :return: arguments
+    :rtype: Dict
+    """
+    parser = ArgumentParser()
+    parser.add_argument('-t', '--tools', dest='tools', nargs='+', choices=TOOLS, default=list(TOOLS))
+    parser.add_argument('-n', '--entities', dest='entities', nargs='+', type=int, default=[10, 1000, 100000])
+    parser.add_argument('-l', '--latency', dest='latency', type=float, default=0.0,
+                        help='seconds added to every stand-in response')
+    parser.add_argument('-p', '--page-size', dest='page_size', type=int, default=1000)
+    parser.add_argument('-r', '--rate-limit-every', dest='rate_limit_every', type=int, default=0,
+                        help='answer every n-th request with 429')
+    parser.add_argument('-a', '--retry-after', dest='retry_after', type=int, default=1)
+    parser.add_argument('-s', '--slack-rate', dest='slack_rate', type=float, default=6000,
+                        help='writes per minute of the Slack tools, 0 for their Tier limits')
+    parser.add_argument('-j', '--json', dest='json', type=str, default=None, help='write results to a json file')
+    return vars(parser.parse_args())
+
+
+def command(tool, entities, directory, url, slack_rate=0):
+    """
+    Command line and environment running a tool against the stand-ins
+
+    :param tool: tool name
+    :type tool: str
+    :param entities: number of SLOs, views, tickets, channels or users
+    :type entities: int
+    :param directory: scratch directory for input files
+    :type directory: Path
+    :param url: base URL of the stand-ins
+    :type url: str
+    :param slack_rate: writes per minute of the Slack tools, 0 for their defaults
+    :type slack_rate: float
+    :return: arguments and environment
+    :rtype: Tuple[List[str], Dict]
+    """
+    env = dict(
+        environ,
+        DATADOG_API_URL=url,
+        ZENDESK_API_URL=url,
+        DATABOX_PUSH_URL=url,
+        SLACK_API_URL=f'{url}/api',
+        SLACK_WEBHOOK=f'{url}/webhook',
+        ZENPY_FORCE_SCHEME='http',
+        ZENPY_FORCE_NETLOC=url.split('://', 1)[1],
+        API_KEY='bench', APP_KEY='bench', ZEN_EMAIL='bench@example.com', ZEN_TOKEN='bench',
+        ZD_EMAIL='bench@example.com', ZD_TOKEN='bench',
+        DATABOX_TOKEN_DATADOG='bench', DATABOX_TOKEN_ZENDESK='bench'
+    )
+    inte = [executable, str(ROOT / 'databox_integration' / 'inte.py'), '-s', str(directory / 'spool')]
+    if tool == 'datadog':
+        ids = directory / 'id.txt'
+        ids.write_text(''.join(f'slo-{number}\n' for number in range(entities)))
+        return inte + ['-D', '-f', str(ids)], env
+    if tool == 'zendesk':
+        views = directory / 'zendesk.json'
+        views.write_text(dumps({
+            f'view-{number}': {
+                'databox_name': f'$view_{number % 10}',
+                'params': {'all': [{'field': 'status', 'operator': 'less_than', 'value': 'pending'}], 'n': number}
+            } for number in range(entities)
+        }))
+        return inte + ['-Z', '-j', str(views)], env
+    if tool == 'watcher':
+        return [executable, str(ROOT / 'zendesk_watcher' / 'watcher.py')], env
+    # the Slack tools apply their changes, so the writes, their journal and the rate limiter are measured
+    rate = ['-r', str(slack_rate)] if slack_rate else []
+    if tool == 'slack_channels':
+        return [executable, str(ROOT / 'slack_rename_channels' / 'slack.py'), '--apply',
+                '-j', str(directory / 'renames.jsonl')] + rate, env
+    return [executable, str(ROOT / 'slack_rename_emails' / 'slack_rename.py'), '--apply',
+            '-j', str(directory / 'emails.jsonl')] + rate, env
+
+
+def run(arguments, env, directory):
+    """
+    Run a tool and measure it
+
+    :param arguments: command line
+    :type arguments: List[str]
+    :param env: environment
+    :type env: Dict
+    :param directory: working directory
+    :type directory: Path
+    :return: exit code, wall seconds, peak RSS in MiB and the tail of stderr
+    :rtype: Tuple[int, float, float, str]
+    """
+    started = perf_counter()
+    process = Popen(arguments, env=env, cwd=directory, stdout=DEVNULL, stderr=PIPE)
+    errors = process.stderr.read()
+    _, status, usage = wait4(process.pid, 0)
+    process.returncode = status
+    elapsed = perf_counter() - started
+    return status >> 8, elapsed, usage.ru_maxrss / 1024, errors.decode(errors='replace').strip()[-300:]
+
+
+def main():
+    """
+    Main function
+    """
+    args = get_arguments()
+    state = MockState(
+        latency=args.get('latency'),
+        page_size=args.get('page_size'),
+        rate_limit_every=args.get('rate_limit_every'),
+        retry_after=args.get('retry_after')
+    )
+    server, url = start(state)
+    results = list()
+    print(f'{"tool":<16}{"entities":>10}{"exit":>6}{"wall s":>10}{"requests":>10}{"429":>6}{"peak MiB":>10}')
+    try:
+        for tool in args.get('tools'):
+            for entities in args.get('entities'):
+                state.reset(entities=entities)
+                with TemporaryDirectory() as directory:
+                    arguments, env = command(tool, entities, Path(directory), url, args.get('slack_rate'))
+                    code, elapsed, peak, errors = run(arguments, env, Path(directory))
+                summary = state.summary()
+                results.append(dict(summary, tool=tool, entities=entities, exit_code=code, wall_seconds=elapsed,
+                                    peak_rss_mib=peak))
+                print(f'{tool:<16}{entities:>10}{code:>6}{elapsed:>10.3f}{summary["requests"]:>10}'
+                      f'{summary["rate_limited"]:>6}{peak:>10.1f}')
+                if code:
+                    print(f'    {errors.splitlines()[-1] if errors else "no output"}')
+    finally:
+        server.shutdown()
+    if args.get('json'):
+        Path(args.get('json')).write_text(dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
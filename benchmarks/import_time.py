@@ -0,0 +1,128 @@
+"""
+Startup cost of the scripts from python -X importtime, tracked across commits in a json history
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from json import dumps, loads
+from pathlib import Path
+from platform import python_version
+from subprocess import DEVNULL, PIPE, run
+from sys import executable
+from time import perf_counter
+
+ROOT = Path(__file__).resolve().parents[1]
+SCRIPTS = {
+    'interpreter': None,
+    'watcher': 'zendesk_watcher/watcher.py',
+    'logparser': 'logparser/parser.py',
+    'mlab': 'mlab/mlab.py',
+    'inte': 'databox_integration/inte.py',
+    'slack_channels': 'slack_rename_channels/slack.py',
+    'slack_emails': 'slack_rename_emails/slack_rename.py',
+}
+
+
+def get_arguments():
+    """
+    Parse call arguments
+
+    :return: arguments
+    :rtype: Dict
+    """
+    parser = ArgumentParser()
+    parser.add_argument('-s', '--scripts', dest='scripts', nargs='+', choices=list(SCRIPTS), default=list(SCRIPTS))
+    parser.add_argument('-n', '--runs', dest='runs', type=int, default=5, help='runs per script, the median is kept')
+    parser.add_argument('-t', '--top', dest='top', type=int, default=5, help='heaviest top level imports shown')
+    parser.add_argument('-H', '--history', dest='history', type=str, default=None,
+                        help='json file the results are appended to, compared with its last entry')
+    return vars(parser.parse_args())
+
+
+def parse_importtime(output):
+    """
+    Top level imports and their cumulative microseconds from the -X importtime report
+
+    :param output: stderr of the run
+    :type output: str
+    :return: cumulative microseconds by top level module and the number of modules imported
+    :rtype: Tuple[Dict, int]
+    """
+    top = dict()
+    modules = 0
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line.split('|', 2)
+        modules += 1
+        name = name[1:]
+        if not name.startswith(' '):
+            top[name] = top.get(name, 0) + int(cumulative)
+    return top, modules
+
+
+def measure(script, runs):
+    """
+    Run a script with --help under -X importtime, nothing is imported after argument parsing
+
+    :param script: path relative to the repository, None for the bare interpreter
+    :type script: str
+    :param runs: number of runs
+    :type runs: int
+    :return: wall and import milliseconds, modules imported and top level imports of the run with the median wall time
+    :rtype: Dict
+    """
+    arguments = [executable, '-X', 'importtime'] + ([str(ROOT / script), '--help'] if script else ['-c', 'pass'])
+    samples = list()
+    for _ in range(runs):
+        started = perf_counter()
+        completed = run(arguments, stdout=DEVNULL, stderr=PIPE, text=True, cwd=ROOT)
+        wall = perf_counter() - started
+        top, modules = parse_importtime(completed.stderr)
+        samples.append((wall, sum(top.values()), modules, top))
+    samples.sort(key=lambda sample: sample[0])
+    wall, imports, modules, top = samples[len(samples) // 2]
+    return {
+        'wall_ms': round(wall * 1000, 1),
+        'import_ms': round(imports / 1000, 1),
+        'modules': modules,
+        'top': dict(sorted(((name, round(value / 1000, 1)) for name, value in top.items()),
+                           key=lambda item: -item[1])),
+    }
+
+
+def git_commit():
+    completed = run(['git', 'rev-parse', '--short', 'HEAD'], stdout=PIPE, stderr=DEVNULL, text=True, cwd=ROOT)
+    return completed.stdout.strip() or None
+
+
+def main():
+    """
+    Main function
+    """
+    args = get_arguments()
+    history = list()
+    if args.get('history') and Path(args.get('history')).exists():
+        history = loads(Path(args.get('history')).read_text())
+    previous = history[-1]['results'] if history else dict()
+    results = dict()
+    print(f'{"script":<16} {"wall ms":>9} {"import ms":>10} {"modules":>8} {"change":>9}  heaviest imports (ms)')
+    for name in args.get('scripts'):
+        result = results[name] = measure(SCRIPTS[name], args.get('runs'))
+        change = ''
+        if name in previous:
+            change = f'{result["wall_ms"] - previous[name]["wall_ms"]:+.1f}'
+        heaviest = ', '.join(f'{module} {value}' for module, value in list(result['top'].items())[:args.get('top')])
+        print(f'{name:<16} {result["wall_ms"]:>9} {result["import_ms"]:>10} {result["modules"]:>8} {change:>9}  '
+              f'{heaviest}')
+    if args.get('history'):
+        history.append({
+            'time': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'commit': git_commit(),
+            'python': python_version(),
+            'results': results,
+        })
+        Path(args.get('history')).write_text(dumps(history, indent=4))
+
+
+if __name__ == '__main__':
+    main()
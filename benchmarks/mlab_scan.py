@@ -0,0 +1,116 @@
+"""
+Benchmark of the mlab report scanner against the original line by line loop
+"""
+from argparse import ArgumentParser
+from os import cpu_count
+from pathlib import Path
+from random import choice, randint, seed
+from re import compile as re_comp, I
+from sys import path as sys_path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+sys_path.append(str(Path(__file__).resolve().parents[1] / 'mlab'))
+from mlab import GIB, rollup, scan  # noqa: E402
+
+ENVIRONMENTS = ['dev', 'prod', 'uat', 'qa', 'stage', 'PROD']
+PROJECTS = ['projects1/projects2/projects3', 'Projects1/projects2/projects3', 'archive/projects9']
+
+
+def get_arguments():
+    """
+    Parse call arguments
+
+    :return: arguments
+    :rtype: Dict
+    """
+    parser = ArgumentParser()
+    parser.add_argument('-l', '--lines', dest='lines', type=int, default=2_000_000)
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=cpu_count())
+    parser.add_argument('-r', '--report', dest='report', type=str, default=None,
+                        help='existing report to scan instead of a generated one')
+    return vars(parser.parse_args())
+
+
+def generate(path, lines):
+    """
+    Write a synthetic storage report
+
+    :param path: path to file
+    :type path: Path
+    :param lines: number of lines
+    :type lines: int
+    """
+    seed(0)
+    with open(path, 'w') as report:
+        for number in range(lines):
+            report.write(f'{choice(ENVIRONMENTS)}-{choice(PROJECTS)}/db{number % 97} - {randint(0, 10 ** 10)}\n')
+
+
+def legacy_loop(path):
+    """
+    The loop mlab used before block scanning, kept as the baseline
+
+    :param path: path to report
+    :type path: Path
+    :return: GiB by project
+    :rtype: Dict
+    """
+    line_re = re_comp(r'^(dev|prod|uat|qa)-(projects1/projects2/projects3).* - (\d+)$', I)
+    data = dict()
+    with open(path) as report:
+        for line in report:
+            match = line_re.match(line)
+            if match:
+                if match.group(2) in data:
+                    data[match.group(2)] += float(match.group(3)) / 1024 / 1024 / 1024
+                else:
+                    data[match.group(2)] = float(match.group(3)) / 1024 / 1024 / 1024
+    return data
+
+
+def measure(name, function, size):
+    """
+    Time one run and print its throughput
+
+    :param name: label
+    :type name: str
+    :param function: scanner returning GiB by project
+    :type function: Callable
+    :param size: report size in bytes
+    :type size: int
+    :return: GiB by project
+    :rtype: Dict
+    """
+    started = perf_counter()
+    result = function()
+    elapsed = perf_counter() - started
+    print(f'{name:<24} {elapsed:8.3f} s {size / elapsed / 1024 / 1024:10.1f} MiB/s')
+    return result
+
+
+def main():
+    """
+    Main function
+    """
+    args = get_arguments()
+    with TemporaryDirectory() as directory:
+        path = Path(args.get('report') or Path(directory) / 'report.txt')
+        if not args.get('report'):
+            generate(path, args.get('lines'))
+        size = path.stat().st_size
+        print(f'report: {path} {size / 1024 / 1024:.1f} MiB')
+        expected = measure('legacy line loop', lambda: legacy_loop(path), size)
+        runs = [('block scan', 1, False), ('block scan, histograms', 1, True),
+                (f'block scan x{args.get("workers")}', args.get('workers'), False)]
+        for name, workers, histogram in runs:
+            result = measure(name, lambda: {
+                project: stats.total / GIB for (project,), stats in
+                rollup(scan(path, dict(), workers=workers, histogram=histogram), ('project',)).items()
+            }, size)
+            assert result.keys() == expected.keys(), f'{name}: projects differ'
+            for project, value in expected.items():
+                assert abs(result[project] - value) <= 1e-9 * max(value, 1), f'{name}: {project} differs'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+"""
+Local stand-ins for the Datadog, Zendesk, Databox and Slack APIs used by the benchmarks
+"""
+from datetime import datetime, timedelta
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps, loads
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qs, unquote, urlencode, urlparse
+
+SEV_FIELD_ID = 58614488
+# tickets keep the same timestamps for the lifetime of the stand-ins
+STARTED = datetime.utcnow()
+
+
+class MockState:
+    """
+    Configuration of the stand-ins and the requests they served
+
+    :param entities: SLOs, views, tickets, channels and users served
+    :type entities: int
+    :param latency: seconds added to every response
+    :type latency: float
+    :param page_size: items per page of paginated listings at most
+    :type page_size: int
+    :param rate_limit_every: every n-th request is answered with 429, 0 disables
+    :type rate_limit_every: int
+    :param retry_after: Retry-After seconds sent with 429
+    :type retry_after: int
+    """
+
+    def __init__(self, entities=10, latency=0.0, page_size=1000, rate_limit_every=0, retry_after=1):
+        self.entities = entities
+        self.latency = latency
+        self.page_size = page_size
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.lock = Lock()
+        # slack names and emails changed by the tools, by channel or user id
+        self.changed = dict()
+        self.requests = dict()
+        self.rate_limited = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.total = 0
+
+    def reset(self, **settings):
+        """
+        Clear the counters and apply new settings
+        """
+        with self.lock:
+            for name, value in settings.items():
+                setattr(self, name, value)
+            self.requests = dict()
+            self.rate_limited = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.total = 0
+
+    def count(self, endpoint, received):
+        """
+        Count a request, True when it has to be rate limited
+        """
+        with self.lock:
+            self.total += 1
+            self.bytes_in += received
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            limited = bool(self.rate_limit_every) and self.total % self.rate_limit_every == 0
+            self.rate_limited += limited
+            return limited
+
+    def summary(self):
+        """
+        Counters as a dict
+        """
+        with self.lock:
+            return {
+                'requests': self.total,
+                'rate_limited': self.rate_limited,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'by_endpoint': dict(self.requests)
+            }
+
+
+def ticket(number, base_url):
+    """
+    Zendesk ticket, every third one is SEV-1 and every third SEV-2, half of them not updated for two days
+    """
+    updated = STARTED - (timedelta(days=2) if number % 2 else timedelta(minutes=5))
+    return {
+        'id': number,
+        'url': f'{base_url}/api/v2/tickets/{number}.json',
+        'subject': f'Ticket {number}',
+        'status': 'open',
+        'organization_id': number % 50 + 1,
+        'group_id': 360015150233,
+        'updated_at': updated.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'created_at': updated.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'custom_fields': [{'id': SEV_FIELD_ID, 'value': f'sev_{number % 3 + 1}'}]
+    }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Routes of all stand-ins, see the do_* methods
+    """
+    protocol_version = 'HTTP/1.1'
+    state: MockState = None
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, payload, status=200, headers=None):
+        body = dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.state.lock:
+            self.state.bytes_out += len(body)
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if body and 'json' in (self.headers.get('Content-Type') or ''):
+            form = loads(body)
+        else:
+            form = {key: values[-1] for key, values in parse_qs(body.decode()).items()}
+        parts = [part for part in url.path.split('/') if part]
+        endpoint = self.endpoint(method, parts)
+        if self.state.latency:
+            sleep(self.state.latency)
+        if self.state.count(endpoint, len(body)):
+            self.respond({'ok': False, 'error': 'ratelimited'}, 429, {'Retry-After': str(self.state.retry_after)})
+            return
+        handler = getattr(self, 'serve_' + endpoint.replace('.', '_').replace(' ', '_'), None)
+        if handler is None:
+            self.respond({'error': f'no stand-in for {method} {url.path}'}, 404)
+            return
+        handler(parts, query, form)
+
+    @staticmethod
+    def endpoint(method, parts):
+        if parts[:3] == ['api', 'v1', 'slo']:
+            return 'datadog slo_history'
+        if parts[:4] == ['api', 'v2', 'views', 'preview']:
+            return 'zendesk view_preview'
+        if parts[:3] == ['api', 'v2', 'search.json']:
+            return 'zendesk search'
+        if parts[:3] == ['api', 'v2', 'organizations']:
+            return 'zendesk organizations'
+        if parts and parts[0] == 'webhook':
+            return 'slack webhook'
+        if len(parts) == 2 and parts[0] == 'api':
+            return f'slack {parts[1]}'
+        if method == 'POST' and not parts:
+            return 'databox push'
+        return f'unknown {method}'
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def base_url(self):
+        return f'http://{self.headers.get("Host")}'
+
+    def serve_datadog_slo_history(self, parts, query, form):
+        slo_id = parts[3]
+        payload = {'data': {'overall': {
+            'name': f'[Bench] SLO {slo_id}',
+            'sli_value': 99.0 + int(slo_id.rsplit('-', 1)[-1]) % 100 / 100,
+            'from_ts': int(query.get('from_ts', 0)),
+            'to_ts': int(query.get('to_ts', 0))
+        }}}
+        # ETag validator to exercise conditional requests, the view preview below sends none
+        etag = f'"{sha1(dumps(payload).encode()).hexdigest()[:16]}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.respond(payload, headers={'ETag': etag, 'Cache-Control': 'private, max-age=0'})
+
+    def serve_zendesk_view_preview(self, parts, query, form):
+        self.respond({'view_count': {'value': len(dumps(form)) % 17, 'fresh': True}})
+
+    def serve_zendesk_search(self, parts, query, form):
+        page = int(query.get('page', 1))
+        size = min(int(query.get('per_page', 100)), self.state.page_size)
+        tickets = [ticket(number, self.base_url()) for number in range(1, self.state.entities + 1)]
+        for term in unquote(query.get('query', '')).split():
+            if term.startswith('updated>'):
+                tickets = [item for item in tickets if item['updated_at'] > term[len('updated>'):]]
+        first = (page - 1) * size
+        next_page = None
+        if first + size < len(tickets):
+            next_page = f'{self.base_url()}/api/v2/search.json?{urlencode(dict(query, page=page + 1, per_page=size))}'
+        self.respond({
+            'results': [dict(item, result_type='ticket') for item in tickets[first:first + size]],
+            'count': len(tickets),
+            'next_page': next_page,
+            'previous_page': None
+        })
+
+    def serve_zendesk_organizations(self, parts, query, form):
+        if parts[3] == 'show_many.json':
+            ids = [int(number) for number in query.get('ids', '').split(',') if number]
+            self.respond({'organizations': [{'id': number, 'name': f'Org {number}'} for number in ids],
+                          'next_page': None, 'count': len(ids)})
+            return
+        number = int(parts[3].split('.')[0])
+        self.respond({'organization': {'id': number, 'name': f'Org {number}'}})
+
+    def serve_databox_push(self, parts, query, form):
+        self.respond({'status': 'OK', 'id': str(len(form.get('data', [])))})
+
+    def serve_slack_webhook(self, parts, query, form):
+        body = b'ok'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def slack_page(self, query, form, key, item):
+        params = dict(query, **form)
+        cursor = int(params.get('cursor') or 0)
+        size = min(int(params.get('limit') or 100), self.state.page_size)
+        items = [item(number) for number in range(cursor, min(cursor + size, self.state.entities))]
+        next_cursor = str(cursor + size) if cursor + size < self.state.entities else ''
+        self.respond({'ok': True, key: items, 'response_metadata': {'next_cursor': next_cursor}})
+
+    def serve_slack_conversations_list(self, parts, query, form):
+        self.slack_page(query, form, 'channels', lambda number: {
+            'id': f'C{number:08d}',
+            'name': self.state.changed.get(f'C{number:08d}', f'og-channel-{number}' if number % 2 else f'team-{number}')
+        })
+
+    def serve_slack_users_list(self, parts, query, form):
+        self.slack_page(query, form, 'members', lambda number: {
+            'id': f'U{number:08d}', 'name': f'user{number}',
+            'profile': {'email': self.state.changed.get(
+                f'U{number:08d}', f'user{number}@{"omnigon.com" if number % 2 else "example.com"}'
+            )}
+        })
+
+    def serve_slack_channels_rename(self, parts, query, form):
+        params = dict(query, **form)
+        with self.state.lock:
+            self.state.changed[params.get('channel')] = params.get('name')
+        self.respond({'ok': True, 'channel': {'id': params.get('channel'), 'name': params.get('name')}})
+
+    serve_slack_conversations_rename = serve_slack_channels_rename
+
+    def serve_slack_users_profile_set(self, parts, query, form):
+        params = dict(query, **form)
+        profile = params.get('profile') or dict()
+        if isinstance(profile, str):
+            profile = loads(profile)
+        if profile.get('email'):
+            with self.state.lock:
+                self.state.changed[params.get('user')] = profile['email']
+        self.respond({'ok': True, 'profile': profile})
+
+
+def start(state=None, host='127.0.0.1', port=0):
+    """
+    Serve the stand-ins from a background thread
+
+    :param state: configuration and counters
+    :type state: MockState
+    :param host: address to listen on
+    :type host: str
+    :param port: port, a free one when 0
+    :type port: int
+    :return: running server and its base URL
+    :rtype: Tuple[ThreadingHTTPServer, str]
+    """
+    handler = type('BoundMockHandler', (MockHandler,), {'state': state or MockState()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_port}'
+
+
+if __name__ == '__main__':
+    SERVER, URL = start(port=8099)
+    print(f'Stand-ins listening on {URL}, Ctrl-C to stop')
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        SERVER.shutdown()
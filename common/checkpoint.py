@@ -0,0 +1,138 @@
+"""
+Checkpoints of append-only input files for incremental runs
+"""
+import sqlite3
+from hashlib import sha1
+from io import RawIOBase
+from json import dumps, loads
+from os import path as os_path
+
+FINGERPRINT_SIZE = 4096
+BLOCK_SIZE = 1 << 16
+
+
+def fingerprint(path, size):
+    """
+    Hash of the first bytes of a file, changes when the file is replaced or rotated
+
+    :param path: path to file
+    :type path: str
+    :param size: number of bytes to hash
+    :type size: int
+    :return: hex digest
+    :rtype: str
+    """
+    with open(path, 'rb') as handle:
+        return sha1(handle.read(size)).hexdigest()
+
+
+def complete_end(path):
+    """
+    Offset right after the last newline, a partially written last line is left for the next run
+
+    :param path: path to file
+    :type path: str
+    :return: byte offset
+    :rtype: int
+    """
+    with open(path, 'rb') as handle:
+        position = handle.seek(0, 2)
+        while position > 0:
+            start = max(0, position - BLOCK_SIZE)
+            handle.seek(start)
+            index = handle.read(position - start).rfind(b'\n')
+            if index != -1:
+                return start + index + 1
+            position = start
+    return 0
+
+
+class BoundedReader(RawIOBase):
+    """
+    Raw reader of a binary file from its current position up to a given offset
+    """
+
+    def __init__(self, handle, end):
+        super().__init__()
+        self.handle = handle
+        self.end = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        left = self.end - self.handle.tell()
+        if left <= 0:
+            return 0
+        with memoryview(buffer) as view:
+            return self.handle.readinto(view[:left])
+
+
+class Checkpoint:
+    """
+    SQLite store with the byte offset, a fingerprint and the running state of every input file
+
+    :param path: path to the state file
+    :type path: str
+    :param namespace: name of the tool, several tools can share one state file
+    :type namespace: str
+    """
+
+    def __init__(self, path, namespace):
+        self.namespace = namespace
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS checkpoints ('
+            'namespace TEXT, path TEXT, offset INTEGER, fingerprint_size INTEGER, fingerprint TEXT, state TEXT, '
+            'PRIMARY KEY (namespace, path))'
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close the state file
+        """
+        self.connection.close()
+
+    def resume(self, path):
+        """
+        Offset to continue from and the state saved with it
+
+        :param path: path to the input file
+        :type path: str
+        :return: offset and state, 0 and None for a new, truncated or replaced file
+        :rtype: Tuple[int, Any]
+        """
+        row = self.connection.execute(
+            'SELECT offset, fingerprint_size, fingerprint, state FROM checkpoints WHERE namespace = ? AND path = ?',
+            (self.namespace, os_path.abspath(path))
+        ).fetchone()
+        if not row:
+            return 0, None
+        offset, size, digest, state = row
+        if os_path.getsize(path) < offset or fingerprint(path, size) != digest:
+            return 0, None
+        return offset, loads(state)
+
+    def save(self, path, offset, state):
+        """
+        Store the offset reached and the state at that offset
+
+        :param path: path to the input file
+        :type path: str
+        :param offset: byte offset parsed up to
+        :type offset: int
+        :param state: json serializable running totals
+        :type state: Any
+        """
+        size = min(offset, FINGERPRINT_SIZE)
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?)',
+                (self.namespace, os_path.abspath(path), offset, size, fingerprint(path, size), dumps(state))
+            )
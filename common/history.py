@@ -0,0 +1,322 @@
+"""
+History of the usage and storage reports as one uncompressed Arrow IPC file per day,
+read zero-copy through memory maps
+
+    <root>/<dataset>/day=<YYYY-MM-DD>/data.arrow
+
+Every ingestion of ranges of input files adds rows tagged in the source column with a hash of the
+ranges, so ingesting the same ranges again replaces those rows instead of counting them twice.
+The ranges of every hash are kept in the file metadata, and the rows of earlier ingestions whose
+ranges all lie within the new ones, e.g. the head of a file that has grown since, are replaced too.
+The rows of a day are compacted into its file on every write, files of the older layout with
+one part-<source hash>.arrow per ingestion are read as well and folded in on the next write.
+
+Query from the command line with
+
+    python -m common.history <root> storage --by project --from 2026-01-01 --to 2026-12-31
+"""
+from argparse import ArgumentParser
+from datetime import date
+from hashlib import sha1
+from json import dumps, loads
+from os import listdir, makedirs, path as os_path, remove, replace
+from sys import exit as sys_exit
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import ipc
+from common.checkpoint import FINGERPRINT_SIZE, fingerprint
+
+DATASETS = {
+    # logparser, Live Indexed per Org
+    'usage': {
+        'keys': ('org',),
+        'values': {'live_indexed': 'sum'},
+        'schema': pa.schema([('org', pa.string()), ('live_indexed', pa.float64())]),
+    },
+    # mlab, bytes per environment and project
+    'storage': {
+        'keys': ('env', 'project'),
+        'values': {'count': 'sum', 'total_bytes': 'sum', 'min_bytes': 'min', 'max_bytes': 'max'},
+        'schema': pa.schema([
+            ('env', pa.string()), ('project', pa.string()), ('count', pa.int64()), ('total_bytes', pa.int64()),
+            ('min_bytes', pa.int64()), ('max_bytes', pa.int64())
+        ]),
+    },
+}
+PARTITION = 'day='
+DAY_FILE = 'data.arrow'
+SOURCE = 'source'
+# file metadata key of the ranges of every source
+SOURCES = b'sources'
+PART_PREFIX = 'part-'
+SUFFIX = '.arrow'
+
+
+def source_range(path, start, end):
+    """
+    Identify a range of an input file by its path, the fingerprint of its head and the offsets
+
+    :param path: path to the input file
+    :type path: str
+    :param start: byte offset the range starts at
+    :type start: int
+    :param end: byte offset the range ends at
+    :type end: int
+    :return: path, fingerprint, start and end
+    :rtype: Tuple[str, str, int, int]
+    """
+    # only the head up to the end of the range, so that it stays the same while the file grows
+    return os_path.abspath(path), fingerprint(path, min(end, FINGERPRINT_SIZE)), start, end
+
+
+def contains(outer, inner):
+    """
+    Whether a range of an input file lies within another range of the same file
+
+    :param outer: path, fingerprint, start and end of the range ingested now
+    :type outer: Tuple[str, str, int, int]
+    :param inner: path, fingerprint, start and end of a range ingested before
+    :type inner: Tuple[str, str, int, int]
+    :return: True when inner is part of outer
+    :rtype: bool
+    """
+    path, _, start, end = outer
+    inner_path, inner_fingerprint, inner_start, inner_end = inner
+    if path != inner_path or inner_start < start or inner_end > end or not os_path.isfile(path):
+        return False
+    return fingerprint(path, min(inner_end, FINGERPRINT_SIZE)) == inner_fingerprint
+
+
+def source_key(ranges):
+    """
+    Name of the part holding the given ranges of input files
+
+    :param ranges: path, fingerprint of the head of the file, start and end offsets
+    :type ranges: Iterable[Tuple[str, str, int, int]]
+    :return: hex digest
+    :rtype: str
+    """
+    return sha1(repr(sorted(ranges)).encode()).hexdigest()[:16]
+
+
+def write_part(root, dataset, day, rows, ranges):
+    """
+    Write the rows ingested from the ranges of input files to the file of a day, replacing rows
+    ingested before from the same ranges or from ranges within them
+
+    :param root: history directory
+    :type root: str
+    :param dataset: usage or storage
+    :type dataset: str
+    :param day: day the data belongs to
+    :type day: date
+    :param rows: column values by name
+    :type rows: Dict[str, List]
+    :param ranges: path, fingerprint of the head of the file, start and end offsets
+    :type ranges: Iterable[Tuple[str, str, int, int]]
+    :return: path of the day file, None when there was nothing to write
+    :rtype: str
+    """
+    schema = DATASETS[dataset]['schema']
+    table = pa.table({name: pa.array(rows[name], field.type) for name, field in zip(schema.names, schema)})
+    if not table.num_rows:
+        return None
+    return compact(root, dataset, day, source_key(ranges), table, ranges)
+
+
+def compact(root, dataset, day, key=None, table=None, ranges=()):
+    """
+    Rewrite the files of a day as one, the rows of the source key and of the sources whose
+    ranges all lie within the given ranges are replaced by the given rows
+
+    :param root: history directory
+    :type root: str
+    :param dataset: usage or storage
+    :type dataset: str
+    :param day: day to compact
+    :type day: date
+    :param key: source of the rows to replace
+    :type key: str
+    :param table: rows of the source, with the dataset columns
+    :type table: pa.Table
+    :param ranges: path, fingerprint of the head of the file, start and end offsets of the source
+    :type ranges: Iterable[Tuple[str, str, int, int]]
+    :return: path of the day file, None when the day has no rows
+    :rtype: str
+    """
+    names = DATASETS[dataset]['schema'].names + [SOURCE]
+    directory = os_path.join(root, dataset, f'{PARTITION}{day.isoformat()}')
+    makedirs(directory, exist_ok=True)
+    ranges = [list(source) for source in ranges]
+    tables = list()
+    sources = dict()
+    compacted = list()
+    for name in sorted(listdir(directory)):
+        if not name.endswith(SUFFIX):
+            continue
+        compacted.append(os_path.join(directory, name))
+        with pa.memory_map(compacted[-1]) as source:
+            existing = ipc.open_file(source).read_all()
+        if SOURCE not in existing.column_names:
+            # part of the older layout, named after its source
+            existing = existing.append_column(SOURCE, pa.array(
+                [name[len(PART_PREFIX):-len(SUFFIX)]] * existing.num_rows, pa.string()
+            ))
+        sources.update(loads((existing.schema.metadata or dict()).get(SOURCES, b'{}')))
+        tables.append(existing.select(names))
+    if key is not None:
+        replaced = [key] + [
+            other for other, other_ranges in sources.items()
+            if other_ranges and all(any(contains(new, old) for new in ranges) for old in other_ranges)
+        ]
+        tables = [existing.filter(pc.invert(pc.is_in(existing[SOURCE], pa.array(replaced, pa.string()))))
+                  for existing in tables]
+    if table is not None:
+        tables.append(table.append_column(SOURCE, pa.array([key] * table.num_rows, pa.string())).select(names))
+        sources[key] = ranges
+    if not tables:
+        return None
+    path = os_path.join(directory, DAY_FILE)
+    if compacted == [path] and table is None:
+        return path
+    temporary = f'{path}.tmp'
+    day_table = pa.concat_tables(tables).combine_chunks()
+    kept = set(day_table[SOURCE].unique().to_pylist())
+    day_table = day_table.replace_schema_metadata({
+        SOURCES: dumps({other: other_ranges for other, other_ranges in sources.items() if other in kept})
+    })
+    with ipc.new_file(temporary, day_table.schema) as writer:
+        writer.write_table(day_table)
+    replace(temporary, path)
+    for other in compacted:
+        if other != path:
+            remove(other)
+    return path
+
+
+def parts(root, dataset, start=None, end=None):
+    """
+    Files of the days between start and end inclusive, the partitions outside are not opened
+
+    :param root: history directory
+    :type root: str
+    :param dataset: usage or storage
+    :type dataset: str
+    :param start: first day
+    :type start: date
+    :param end: last day
+    :type end: date
+    :return: day and path of every file
+    :rtype: Iterator[Tuple[date, str]]
+    """
+    base = os_path.join(root, dataset)
+    if not os_path.isdir(base):
+        return
+    for partition in sorted(listdir(base)):
+        if not partition.startswith(PARTITION):
+            continue
+        day = date.fromisoformat(partition[len(PARTITION):])
+        if (start and day < start) or (end and day > end):
+            continue
+        for name in sorted(listdir(os_path.join(base, partition))):
+            if name.endswith(SUFFIX):
+                yield day, os_path.join(base, partition, name)
+
+
+def read(root, dataset, start=None, end=None, columns=None):
+    """
+    Rows of the days between start and end with a day column, the files are memory mapped
+
+    :param root: history directory
+    :type root: str
+    :param dataset: usage or storage
+    :type dataset: str
+    :param start: first day
+    :type start: date
+    :param end: last day
+    :type end: date
+    :param columns: columns to read, all when not given
+    :type columns: List[str]
+    :return: rows
+    :rtype: pa.Table
+    """
+    schema = DATASETS[dataset]['schema']
+    columns = list(columns or schema.names)
+    tables = list()
+    for day, path in parts(root, dataset, start, end):
+        with pa.memory_map(path) as source:
+            table = ipc.open_file(source).read_all().select(columns)
+        tables.append(table.append_column('day', pa.array([day] * table.num_rows, pa.date32())))
+    if not tables:
+        return pa.table({name: pa.array([], schema.field(name).type) for name in columns}
+                        | {'day': pa.array([], pa.date32())})
+    return pa.concat_tables(tables)
+
+
+def query(root, dataset, by, start=None, end=None):
+    """
+    Totals grouped by the given columns over the days between start and end
+
+    :param root: history directory
+    :type root: str
+    :param dataset: usage or storage
+    :type dataset: str
+    :param by: columns to group by, out of the dataset keys and day
+    :type by: List[str]
+    :param start: first day
+    :type start: date
+    :param end: last day
+    :type end: date
+    :return: rows with the group columns and the aggregated values
+    :rtype: List[Dict]
+    :raises ValueError: a column to group by is not a key of the dataset
+    """
+    values = DATASETS[dataset]['values']
+    unknown = set(by) - set(DATASETS[dataset]['keys']) - {'day'}
+    if unknown:
+        raise ValueError(f'cannot group {dataset} by {", ".join(sorted(unknown))}')
+    table = read(root, dataset, start, end, [column for column in by if column != 'day'] + list(values))
+    if not by:
+        return [{name: getattr(pc, function)(table[name]).as_py() for name, function in values.items()}]
+    grouped = table.group_by(list(by)).aggregate(list(values.items()))
+    # aggregates are named like count_sum
+    names = {f'{name}_{function}': name for name, function in values.items()}
+    grouped = grouped.rename_columns([names.get(name, name) for name in grouped.column_names])
+    return grouped.select(list(by) + list(values)).sort_by([(column, 'ascending') for column in by]).to_pylist()
+
+
+def get_arguments():
+    """
+    Parse call arguments
+    """
+    parser = ArgumentParser(description='Query the usage and storage history')
+    parser.add_argument('root', type=str, help='history directory')
+    parser.add_argument('dataset', type=str, choices=sorted(DATASETS))
+    parser.add_argument('-b', '--by', dest='by', type=str, default='',
+                        help='comma separated columns to group by, the dataset keys and day')
+    parser.add_argument('--from', dest='start', type=date.fromisoformat, default=None, help='first day, YYYY-MM-DD')
+    parser.add_argument('--to', dest='end', type=date.fromisoformat, default=None, help='last day, YYYY-MM-DD')
+    parser.add_argument('--compact', dest='compact', action='store_true',
+                        help='rewrite the days in the range that still have several files as one file each')
+    return vars(parser.parse_args())
+
+
+def main():
+    args = get_arguments()
+    if args.get('compact'):
+        for day in sorted({day for day, _ in parts(args.get('root'), args.get('dataset'), args.get('start'),
+                                                  args.get('end'))}):
+            compact(args.get('root'), args.get('dataset'), day)
+        return
+    by = [column.strip() for column in args.get('by').split(',') if column.strip()]
+    try:
+        rows = query(args.get('root'), args.get('dataset'), by, args.get('start'), args.get('end'))
+    except ValueError as error:
+        print(error)
+        sys_exit(1)
+    for row in rows:
+        print(' '.join(str(value) for value in row.values()))
+
+
+if __name__ == '__main__':
+    main()
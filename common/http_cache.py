@@ -0,0 +1,213 @@
+"""
+Cache of API read responses in SQLite with LRU eviction. ETag, Last-Modified and Cache-Control are
+honoured for GET requests where the API sends them, otherwise, and for reads sent as POST, a response
+whose body hashes the same as the cached one is recognised as unchanged. The parsed value is cached
+rather than the body, so an unchanged response is not downloaded again (304 or still fresh), not parsed
+again (same hash) and its stored value is not rewritten; the stored value is decoded once per process
+"""
+import sqlite3
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from hashlib import sha1
+from json import dumps, loads
+from threading import Lock
+from time import time
+from common.metrics import METRICS
+
+
+def expires_at(response, now):
+    """
+    Time until which a response can be used without asking the server, from Cache-Control or Expires
+
+    :param response: server response
+    :type response: Response
+    :param now: current time
+    :type now: float
+    :return: expiry time, now when it has to be revalidated, None when it must not be stored
+    :rtype: float
+    """
+    directives = dict()
+    for directive in response.headers.get('Cache-Control', '').lower().split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name] = value.strip('"')
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return now
+    if directives.get('max-age', '').isdigit():
+        return now + int(directives['max-age'])
+    try:
+        return max(now, parsedate_to_datetime(response.headers['Expires']).timestamp())
+    except (KeyError, TypeError, ValueError):
+        return now
+
+
+class HttpCache:
+    """
+    Parsed responses by request key, safe to share between threads
+
+    :param path: SQLite file
+    :type path: str
+    :param max_entries: responses kept at most, least recently used are evicted
+    :type max_entries: int
+    """
+
+    def __init__(self, path, max_entries=10000):
+        self.max_entries = max_entries
+        self.lock = Lock()
+        # decoded values of the entries used by this process, by key with their body hash
+        self.values = OrderedDict()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, '
+                'expires REAL, digest TEXT, value TEXT, used REAL)'
+            )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+            self.evict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close the cache file
+        """
+        with self.lock:
+            self.connection.close()
+
+    def lookup(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT etag, last_modified, expires, digest, value FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+        return row
+
+    def remember(self, key, digest, value):
+        """
+        Keep the decoded value of an entry for the rest of the process
+        """
+        with self.lock:
+            self.values[key] = (digest, value)
+            self.values.move_to_end(key)
+            while len(self.values) > self.max_entries:
+                self.values.popitem(last=False)
+
+    def value(self, key, digest, text):
+        """
+        Decoded value of an entry, the stored text is only decoded on the first use in the process
+        """
+        with self.lock:
+            cached = self.values.get(key)
+        if cached and cached[0] == digest:
+            return cached[1]
+        value = loads(text)
+        self.remember(key, digest, value)
+        return value
+
+    def store(self, key, response, digest, value, now):
+        """
+        Keep a parsed response with its validators, evicting the least recently used ones
+        """
+        expires = expires_at(response, now)
+        with self.lock, self.connection:
+            if expires is None:
+                self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                return
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, response.headers.get('ETag'), response.headers.get('Last-Modified'), expires, digest,
+                 dumps(value), now)
+            )
+            self.evict()
+        self.remember(key, digest, value)
+
+    def evict(self):
+        """
+        Delete the least recently used responses above max_entries, called inside a transaction
+        """
+        self.connection.execute(
+            'DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+
+    def refresh(self, key, response, now):
+        """
+        Mark an entry as used, with the new expiry of the 304 response confirming it when given
+        """
+        expires = expires_at(response, now) if response is not None else None
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE responses SET used = ?, expires = COALESCE(?, expires) WHERE key = ?', (now, expires, key)
+            )
+
+    def revalidate(self, key, response, now):
+        """
+        Take the validators and expiry of a response with the body of the entry, the stored value is kept as is
+
+        :return: False when the response must not be stored and the entry was dropped
+        :rtype: bool
+        """
+        expires = expires_at(response, now)
+        with self.lock, self.connection:
+            if expires is None:
+                self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                return False
+            self.connection.execute(
+                'UPDATE responses SET etag = ?, last_modified = ?, expires = ?, used = ? WHERE key = ?',
+                (response.headers.get('ETag'), response.headers.get('Last-Modified'), expires, now, key)
+            )
+        return True
+
+    def fetch(self, key, send, parse, name='http', method='GET'):
+        """
+        Parsed response of a request, from the cache when it is still fresh or the server confirms it.
+        Other requests than GET are always sent, without conditional headers that would fail them with 412,
+        and only recognised as unchanged by the hash of their body
+
+        :param key: request key, e.g. method, url and body
+        :type key: str
+        :param send: function sending the request with the extra conditional headers and returning the response
+        :type send: Callable
+        :param parse: function turning a response into a json serializable value
+        :type parse: Callable
+        :param name: call name in the metrics
+        :type name: str
+        :param method: HTTP method of the request
+        :type method: str
+        :return: parsed response
+        :rtype: Any
+        """
+        now = time()
+        entry = self.lookup(key)
+        if entry is not None:
+            etag, last_modified, expires, digest, text = entry
+            conditional = method == 'GET'
+            if conditional and expires > now:
+                METRICS.count('http_cache_total', call=name, outcome='fresh')
+                self.refresh(key, None, now)
+                return self.value(key, digest, text)
+            headers = dict()
+            if conditional and etag:
+                headers['If-None-Match'] = etag
+            if conditional and last_modified:
+                headers['If-Modified-Since'] = last_modified
+            response = send(headers)
+            if response.status_code == 304:
+                METRICS.count('http_cache_total', call=name, outcome='not_modified')
+                self.refresh(key, response, now)
+                return self.value(key, digest, text)
+            if sha1(response.content).hexdigest() == digest:
+                METRICS.count('http_cache_total', call=name, outcome='same_content')
+                if self.revalidate(key, response, now):
+                    return self.value(key, digest, text)
+                return loads(text)
+        else:
+            response = send(dict())
+        METRICS.count('http_cache_total', call=name, outcome='miss')
+        value = parse(response)
+        self.store(key, response, sha1(response.content).hexdigest(), value, now)
+        return value
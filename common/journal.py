@@ -0,0 +1,78 @@
+"""
+Append-only json lines journal of bulk operations, makes them resumable
+"""
+from json import dumps, loads
+from threading import Lock
+from time import time
+
+
+def read_jsonl(path):
+    """
+    Read json lines file, missing file is empty, a line cut by an interrupted write is skipped
+
+    :param path: path to file
+    :type path: str
+    :return: records
+    :rtype: List[Dict]
+    """
+    records = list()
+    try:
+        with open(path) as jsonl_file:
+            for line in jsonl_file:
+                try:
+                    records.append(loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+
+class Journal:
+    """
+    Results of a bulk operation, one line per item flushed as soon as it is known,
+    safe to write from several threads
+
+    :param path: path to the journal
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.handle = None
+
+    def __enter__(self):
+        self.handle = open(self.path, 'a')
+        return self
+
+    def __exit__(self, *exc_info):
+        self.handle.close()
+
+    def latest(self, key='id', where=None):
+        """
+        Last entry of every item
+
+        :param key: field identifying the item
+        :type key: str
+        :param where: only entries it returns True for are considered, e.g. the successful ones
+        :type where: Callable
+        :return: entries by item
+        :rtype: Dict
+        """
+        return {
+            entry[key]: entry for entry in read_jsonl(self.path)
+            if key in entry and (where is None or where(entry))
+        }
+
+    def write(self, **entry):
+        """
+        Append an entry with the current time
+
+        :param entry: entry fields
+        :type entry: Dict
+        """
+        line = dumps(dict(entry, time=int(time()))) + '\n'
+        with self.lock:
+            self.handle.write(line)
+            self.handle.flush()
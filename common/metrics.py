@@ -0,0 +1,309 @@
+"""
+Run metrics shared by the tools: call latency histograms, counters and phase timings,
+exported as a Prometheus textfile, StatsD packets and a json run summary
+"""
+import atexit
+import socket
+from contextlib import contextmanager
+from json import dumps
+from os import replace
+from sys import stderr
+from threading import Lock
+from time import monotonic, time
+
+# seconds, the Prometheus client defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+PREFIX = 'ix'
+
+
+def escape_label(value):
+    """
+    Label value escaped for the Prometheus text format
+
+    :param value: label value
+    :type value: Any
+    :return: value with backslashes, double quotes and newlines escaped
+    :rtype: str
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """
+    Cumulative histogram of observed values with their count, sum and maximum
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'total', 'maximum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    def quantile(self, fraction):
+        """
+        Upper bound of the bucket the quantile falls into, the maximum above the last bucket
+        """
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.maximum)
+        return self.maximum
+
+
+class Metrics:
+    """
+    Registry of counters and histograms by name and labels, safe to use from several threads
+
+    :param tool: name of the tool, added as a label to every series
+    :type tool: str
+    """
+
+    def __init__(self, tool=None):
+        self.tool = tool
+        self.lock = Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.statsd = None
+        self.started = time()
+
+    def key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def count(self, name, value=1, **labels):
+        """
+        Add to a counter
+
+        :param name: counter name
+        :type name: str
+        :param value: amount
+        :type value: float
+        :param labels: series labels
+        :type labels: Dict
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        if self.statsd:
+            self.send(name, labels, f'{value}|c')
+
+    def observe(self, name, value, **labels):
+        """
+        Add a value to a histogram
+
+        :param name: histogram name
+        :type name: str
+        :param value: observed value, seconds for timings
+        :type value: float
+        :param labels: series labels
+        :type labels: Dict
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+        if self.statsd:
+            self.send(name, labels, f'{value * 1000:.3f}|ms')
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Time the block into a histogram
+        """
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - started, **labels)
+
+    def call(self, name, seconds, outcome, retries=0, sent=0, received=0):
+        """
+        Record one outbound API call with its retries and payload sizes
+
+        :param name: call name, e.g. datadog.slo_history
+        :type name: str
+        :param seconds: latency including retries
+        :type seconds: float
+        :param outcome: ok, or the error
+        :type outcome: str
+        :param retries: retries after the first attempt
+        :type retries: int
+        :param sent: request bytes
+        :type sent: int
+        :param received: response bytes
+        :type received: int
+        """
+        self.observe('api_call_seconds', seconds, call=name)
+        self.count('api_calls_total', call=name, outcome=outcome)
+        if retries:
+            self.count('api_retries_total', retries, call=name)
+        if sent:
+            self.count('api_sent_bytes_total', sent, call=name)
+        if received:
+            self.count('api_received_bytes_total', received, call=name)
+
+    def phase(self, name):
+        """
+        Time a processing phase
+        """
+        return self.timer('phase_seconds', phase=name)
+
+    def connect_statsd(self, address):
+        """
+        Send every counter increment and observation to a StatsD server as they happen
+
+        :param address: host:port
+        :type address: str
+        """
+        host, _, port = address.rpartition(':')
+        self.statsd = (socket.socket(socket.AF_INET, socket.SOCK_DGRAM), (host or 'localhost', int(port or 8125)))
+
+    def send(self, name, labels, value):
+        sock, address = self.statsd
+        # dogstatsd style tags, plain statsd servers ignore them
+        tags = ','.join(f'{label}:{labels[label]}' for label in sorted(labels))
+        if self.tool:
+            tags = f'tool:{self.tool},{tags}' if tags else f'tool:{self.tool}'
+        line = f'{PREFIX}.{name}:{value}' + (f'|#{tags}' if tags else '')
+        try:
+            sock.sendto(line.encode(), address)
+        except OSError:
+            pass
+
+    def format_labels(self, labels, extra=()):
+        pairs = ([('tool', self.tool)] if self.tool else []) + list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+    def prometheus(self):
+        """
+        Series in the Prometheus text exposition format
+
+        :return: text
+        :rtype: str
+        """
+        lines = list()
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {PREFIX}_{name} counter')
+            lines.append(f'{PREFIX}_{name}{self.format_labels(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {PREFIX}_{name} histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{PREFIX}_{name}_bucket{self.format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{PREFIX}_{name}_bucket{self.format_labels(labels, [("le", "+Inf")])} {histogram.count}')
+            lines.append(f'{PREFIX}_{name}_sum{self.format_labels(labels)} {histogram.total}')
+            lines.append(f'{PREFIX}_{name}_count{self.format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Run summary with counters and the count, sum, mean, p50, p90, p99 and max of every histogram
+
+        :return: summary
+        :rtype: Dict
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        result = {'tool': self.tool, 'started': int(self.started), 'seconds': round(time() - self.started, 3),
+                  'counters': list(), 'histograms': list()}
+        for (name, labels), value in counters:
+            result['counters'].append(dict(labels, name=name, value=value))
+        for (name, labels), histogram in histograms:
+            result['histograms'].append(dict(
+                labels, name=name, count=histogram.count, sum=round(histogram.total, 6),
+                mean=round(histogram.total / histogram.count, 6) if histogram.count else None,
+                p50=round(histogram.quantile(0.5), 6), p90=round(histogram.quantile(0.9), 6),
+                p99=round(histogram.quantile(0.99), 6),
+                max=round(histogram.maximum, 6)
+            ))
+        return result
+
+    def export(self, prometheus=None, summary=None):
+        """
+        Write the Prometheus textfile and the json summary, each replaced atomically
+
+        :param prometheus: path of the textfile, for the node exporter textfile collector
+        :type prometheus: str
+        :param summary: path of the json summary, - for stderr
+        :type summary: str
+        """
+        for path, text in ((prometheus, self.prometheus), (summary, lambda: dumps(self.summary(), indent=2))):
+            if not path:
+                continue
+            if path == '-':
+                print(text(), file=stderr)
+                continue
+            temporary = f'{path}.tmp'
+            with open(temporary, 'w') as metrics_file:
+                metrics_file.write(text())
+            replace(temporary, path)
+
+
+METRICS = Metrics()
+
+
+def add_arguments(parser):
+    """
+    Add the metrics export options to a tool's argument parser
+    """
+    parser.add_argument('--metrics-json', dest='metrics_json', type=str, default=None,
+                        help='write a json summary of call latencies, counts and phase timings, - for stderr')
+    parser.add_argument('--metrics-prom', dest='metrics_prom', type=str, default=None,
+                        help='write the metrics as a Prometheus textfile')
+    parser.add_argument('--statsd', dest='statsd', type=str, default=None,
+                        help='send the metrics to a StatsD server at host:port')
+
+
+def setup(tool, args):
+    """
+    Name the metrics of this run, connect StatsD and export the metrics at exit as asked for
+
+    :param tool: tool name
+    :type tool: str
+    :param args: command line arguments
+    :type args: Dict
+    """
+    METRICS.tool = tool
+    if args.get('statsd'):
+        METRICS.connect_statsd(args.get('statsd'))
+    if args.get('metrics_prom') or args.get('metrics_json'):
+        atexit.register(export, args)
+
+
+def export(args):
+    """
+    Export the metrics as asked for on the command line
+
+    :param args: command line arguments
+    :type args: Dict
+    """
+    try:
+        METRICS.export(args.get('metrics_prom'), args.get('metrics_json'))
+    except OSError as error:
+        print(f'Could not write metrics: {error}')
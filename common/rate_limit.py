@@ -0,0 +1,84 @@
+"""
+Client side rate limiting shared by the API tools
+"""
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from time import monotonic, sleep, time
+
+
+class TokenBucket:
+    """
+    Token bucket shared by the threads sending to one API
+
+    :param rate: tokens added per second
+    :type rate: float
+    :param capacity: tokens that can be spent in a burst, at least 1
+    :type capacity: float
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        # below one token acquire(1) could never be satisfied and would wait forever
+        capacity = max(1, capacity)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Block until the tokens can be spent
+
+        :param tokens: tokens to spend
+        :type tokens: float
+        :return: seconds waited
+        :rtype: float
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = monotonic()
+                if now > self.updated:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = max(0.0, self.updated - now) + (tokens - self.tokens) / self.rate
+            sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """
+        Hold every sender back, e.g. for the Retry-After of a 429 response
+
+        :param seconds: seconds before the next token
+        :type seconds: float
+        """
+        with self.lock:
+            self.tokens = min(self.tokens, 0)
+            self.updated = max(self.updated, monotonic() + seconds)
+
+
+def retry_after(response, default):
+    """
+    Seconds to wait before retrying, from the Retry-After header if the server sent one
+
+    :param response: server response
+    :type response: Response
+    :param default: delay when there is no usable header
+    :type default: float
+    :return: delay in seconds
+    :rtype: float
+    """
+    header = response.headers.get('Retry-After')
+    if not header:
+        return default
+    try:
+        return max(0.0, float(header))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(header).timestamp() - time())
+    except (TypeError, ValueError):
+        return default
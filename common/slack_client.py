@@ -0,0 +1,199 @@
+"""
+Slack Web API client shared by the Slack tools: keep-alive connections, per method rate limits,
+Retry-After handling and cursor pagination
+"""
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+from threading import Lock
+from time import monotonic
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from common.metrics import METRICS
+from common.rate_limit import TokenBucket, retry_after
+
+SLACK_API_URL = environ.get('SLACK_API_URL', 'https://slack.com/api')
+# requests per minute of the methods in use, https://api.slack.com/docs/rate-limits
+TIER_1 = 1
+TIER_2 = 20
+TIER_3 = 50
+TIER_4 = 100
+METHOD_RATES = {
+    'conversations.list': TIER_2,
+    'conversations.rename': TIER_2,
+    'channels.rename': TIER_2,
+    'users.list': TIER_2,
+    'users.profile.get': TIER_4,
+    'users.profile.set': TIER_3,
+}
+READ_METHODS = ('conversations.list', 'users.list', 'users.profile.get')
+
+
+class SlackError(Exception):
+    """
+    Slack method call that failed, error is the slack error code or the transport failure
+    """
+
+    def __init__(self, method, error):
+        super().__init__(f'{method} failed: {error}')
+        self.method = method
+        self.error = error
+
+
+class SlackClient:
+    """
+    Slack Web API client, safe to share between threads
+
+    :param token: slack token, sent as a Bearer header
+    :type token: str
+    :param base_url: api url
+    :type base_url: str
+    :param pool_size: connections kept alive
+    :type pool_size: int
+    :param retries: attempts after a 429, 5xx or connection error
+    :type retries: int
+    :param timeout: seconds per request
+    :type timeout: float
+    :param http2: use httpx with HTTP/2, multiplexing all calls over one connection
+    :type http2: bool
+    """
+
+    def __init__(self, token, base_url=SLACK_API_URL, pool_size=4, retries=5, timeout=30, http2=False):
+        self.base_url = base_url.rstrip('/')
+        self.retries = retries
+        self.timeout = timeout
+        self.headers = {'Authorization': f'Bearer {token}'}
+        self.lock = Lock()
+        self.buckets = dict()
+        self.stats = dict()
+        if http2:
+            # optional dependency, pip install httpx[http2]
+            import httpx
+            self.session = httpx.Client(http2=True, limits=httpx.Limits(max_connections=pool_size),
+                                        timeout=timeout)
+            self.transport_errors = (httpx.HTTPError,)
+        else:
+            self.session = Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+            self.transport_errors = (RequestException,)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def limit(self, method, per_minute, burst=None):
+        """
+        Set the rate limit of a method
+
+        :param method: slack api method
+        :type method: str
+        :param per_minute: calls per minute
+        :type per_minute: float
+        :param burst: calls that can be sent at once, a tenth of a minute by default
+        :type burst: float
+        """
+        with self.lock:
+            self.buckets[method] = TokenBucket(per_minute / 60, burst or max(1, per_minute / 10))
+
+    def bucket(self, method):
+        with self.lock:
+            bucket = self.buckets.get(method)
+        if bucket is None:
+            self.limit(method, METHOD_RATES.get(method, TIER_3))
+            bucket = self.buckets[method]
+        return bucket
+
+    def count(self, method, name):
+        with self.lock:
+            counters = self.stats.setdefault(method, {'calls': 0, 'retries': 0, 'errors': 0})
+            counters[name] += 1
+
+    def call(self, method, **params):
+        """
+        Call a method, read methods with GET and the rest with a form POST
+
+        :param method: slack api method
+        :type method: str
+        :param params: method arguments
+        :type params: Dict
+        :return: response payload
+        :rtype: Dict
+        :raises SlackError: slack answered ok false or the call kept failing
+        """
+        url = f'{self.base_url}/{method}'
+        bucket = self.bucket(method)
+        error = 'not sent'
+        # the error without exception messages, a metrics label has to stay within few values
+        outcome = error
+        attempt = 0
+        received = 0
+        started = monotonic()
+        self.count(method, 'calls')
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    self.count(method, 'retries')
+                bucket.acquire()
+                try:
+                    if method in READ_METHODS:
+                        response = self.session.get(url, params=params, headers=self.headers, timeout=self.timeout)
+                    else:
+                        response = self.session.post(url, data=params, headers=self.headers, timeout=self.timeout)
+                except self.transport_errors as exc:
+                    error = str(exc) or type(exc).__name__
+                    outcome = type(exc).__name__
+                    continue
+                received += len(response.content)
+                if response.status_code == 429 or response.status_code >= 500:
+                    error = outcome = 'ratelimited' if response.status_code == 429 else f'HTTP {response.status_code}'
+                    bucket.pause(retry_after(response, 2 ** attempt))
+                    continue
+                if response.status_code != 200:
+                    error = outcome = f'HTTP {response.status_code}'
+                    break
+                try:
+                    result = response.json()
+                except ValueError as exc:
+                    error = f'Malformed JSON: {exc}'
+                    outcome = type(exc).__name__
+                    break
+                if result.get('ok'):
+                    outcome = 'ok'
+                    return result
+                # slack error codes are a fixed set
+                error = outcome = result.get('error') or 'unknown error'
+                break
+            self.count(method, 'errors')
+            raise SlackError(method, error)
+        finally:
+            METRICS.call(f'slack.{method}', monotonic() - started, outcome, attempt, received=received)
+
+    def paginate(self, method, key, **params):
+        """
+        Yield the items of a cursor paginated listing page by page, the next page is requested
+        while the caller is still working on the current one
+
+        :param method: slack api method
+        :type method: str
+        :param key: key of the items in the payload
+        :type key: str
+        :param params: method arguments
+        :type params: Dict
+        :return: items
+        :rtype: Iterator[Dict]
+        :raises SlackError: a page could not be fetched
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self.call, method, **params)
+            while future is not None:
+                result = future.result()
+                cursor = result.get('response_metadata', {}).get('next_cursor')
+                future = executor.submit(self.call, method, **dict(params, cursor=cursor)) if cursor else None
+                yield from result.get(key, ())
@@ -1,18 +1,36 @@
 """
 Integration between Datadog and Databox system. Sends datadog data to Databox system via API.
 """
-from os import getenv
-from time import sleep
+from os import getenv, listdir, makedirs, path as os_path, remove, replace, stat
+from abc import ABC, abstractmethod
+from uuid import uuid4
+from time import monotonic, sleep, time
 from json import dumps, loads
 from datetime import datetime, timedelta
-from logging import getLogger, Logger
-from sys import exit as sys_exit
-from argparse import ArgumentParser
+from logging import basicConfig, getLogger, Logger, INFO
+from sys import exit as sys_exit, path as sys_path
+from argparse import ArgumentParser, ArgumentTypeError
 from base64 import b64encode
-from requests import get, post
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+from threading import Event, Lock, Thread
+from requests import Session
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-from requests.exceptions import HTTPError, ConnectionError as ComError
+from requests.exceptions import HTTPError, ConnectionError as ComError, Timeout
+sys_path.append(os_path.dirname(os_path.dirname(os_path.abspath(__file__))))
+from common import metrics  # noqa: E402
+from common.http_cache import HttpCache  # noqa: E402
+from common.metrics import METRICS  # noqa: E402
+from common.rate_limit import retry_after  # noqa: E402
 LOG: Logger = getLogger('inte')
+DATADOG_API_URL = getenv("DATADOG_API_URL", "https://api.datadoghq.com")
+ZENDESK_API_URL = getenv("ZENDESK_API_URL", "https://thisisix.zendesk.com")
+DATABOX_PUSH_URL = getenv("DATABOX_PUSH_URL", "https://push.databox.com")
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# pushes databox rejected, kept for inspection in the spool directory and never replayed
+DEAD_LETTER = "dead-letter.jsonl"
 
 
 def get_arguments():
@@ -33,10 +51,260 @@ def get_arguments():
     parser.add_argument("-t", "--zendesk-token", dest="zen_token", type=str, default="ZEN_TOKEN")
     parser.add_argument("-j", "--zendesk-json", dest="zen_json", type=str, default="zendesk.json")
     parser.add_argument("-o", "--databox-token-zendesk", dest="dtz_token", type=str, default="DATABOX_TOKEN_ZENDESK")
+    parser.add_argument("-c", "--concurrency", dest="concurrency", type=int, default=8)
+    parser.add_argument("-r", "--retries", dest="retries", type=int, default=3)
+    parser.add_argument("-T", "--timeout", dest="timeout", type=float, default=30,
+                        help="seconds allowed per request including its retries")
+    parser.add_argument("-a", "--zendesk-attempts", dest="zen_attempts", type=int, default=4,
+                        help="previews per view while its count is not fresh")
+    parser.add_argument("-w", "--zendesk-wait", dest="zen_wait", type=float, default=0.5,
+                        help="seconds before the first re-poll of stale views, doubled on every round")
+    parser.add_argument("-b", "--batch-size", dest="batch_size", type=int, default=100,
+                        help="metrics per databox push at most")
+    parser.add_argument("-B", "--batch-bytes", dest="batch_bytes", type=int, default=512 * 1024,
+                        help="encoded size of a databox push at most")
+    parser.add_argument("-s", "--spool-dir", dest="spool_dir", type=str, default="spool",
+                        help="directory keeping pushes that failed, replayed on the next run, and the ones databox "
+                             f"rejected in {DEAD_LETTER}")
+    parser.add_argument("--daemon", dest="daemon", action='store_true',
+                        help="keep running and collect on the intervals below")
+    parser.add_argument("--datadog-interval", dest="datadog_interval", type=float, default=60,
+                        help="seconds between datadog collections in daemon mode")
+    parser.add_argument("--zendesk-interval", dest="zendesk_interval", type=float, default=60,
+                        help="seconds between zendesk collections in daemon mode")
+    parser.add_argument("--budget", dest="budgets", type=parse_budget, action="append",
+                        help="seconds a collector may take, e.g. zendesk=60, repeat for several collectors, "
+                             f"default {Collector.budget}")
+    parser.add_argument("--slo-cache", dest="slo_cache", type=str, default=None,
+                        help="json file caching SLO history results between runs")
+    parser.add_argument("--slo-cache-ttl", dest="slo_cache_ttl", type=float, default=900,
+                        help="seconds a cached SLO history result is used")
+    parser.add_argument("--slo-cache-size", dest="slo_cache_size", type=int, default=10000,
+                        help="cached SLO history results at most, least recently used are evicted")
+    parser.add_argument("--http-cache", dest="http_cache", type=str, default=None,
+                        help="SQLite file caching SLO histories and view counts, sent again with ETag and "
+                             "Last-Modified validators and not decoded again when unchanged")
+    parser.add_argument("--http-cache-size", dest="http_cache_size", type=int, default=10000,
+                        help="cached responses at most, least recently used are evicted")
+    parser.add_argument("--slo-bucket", dest="slo_bucket", type=int, default=300,
+                        help="seconds the SLO window end is rounded down to when caching")
+    metrics.add_arguments(parser)
     return vars(parser.parse_args())
 
 
+def make_session(pool_size=1):
+    """
+    HTTP session keeping up to pool_size connections alive per host
+
+    :param pool_size: connections per host
+    :type pool_size: int
+    :return: session
+    :rtype: Session
+    """
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def request_with_retry(session, method, url, retries=3, timeout=30, name=None, **kwargs):
+    """
+    Send request, retrying connection errors, 429 and 5xx responses with exponential backoff
+
+    :param session: HTTP session
+    :type session: Session
+    :param method: HTTP method
+    :type method: str
+    :param url: request URL
+    :type url: str
+    :param retries: retries after the first attempt
+    :type retries: int
+    :param timeout: seconds allowed for all attempts together
+    :type timeout: float
+    :param name: name of the call in the metrics, method and host when not given
+    :type name: str
+    :return: successful response
+    :rtype: Response
+    :raises HTTPError: last error response
+    :raises ComError: connection failure of the last attempt
+    :raises Timeout: no response in time
+    """
+    started = monotonic()
+    deadline = started + timeout
+    attempt = 0
+    response = None
+    outcome = "ok"
+    try:
+        for attempt in range(retries + 1):
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise Timeout(f"{method} {url} did not succeed in {timeout} seconds")
+            delay = 2 ** attempt
+            try:
+                response = session.request(method, url, timeout=remaining, **kwargs)
+            except (ComError, Timeout) as error:
+                if attempt == retries:
+                    raise
+                LOG.warning("%s %s failed, retrying: %s", method, url, error)
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == retries:
+                    response.raise_for_status()
+                    return response
+                delay = retry_after(response, delay)
+                LOG.warning("%s %s returned %s, retrying in %.1f s", method, url, response.status_code, delay)
+            if delay >= deadline - monotonic():
+                raise Timeout(f"{method} {url} did not succeed in {timeout} seconds")
+            sleep(delay)
+    except Exception as error:
+        outcome = type(error).__name__
+        raise
+    finally:
+        METRICS.call(
+            name or f"{method} {url.split('/')[2]}", monotonic() - started, outcome, attempt,
+            len(response.request.body or b"") if response is not None else 0,
+            len(response.content) if response is not None else 0
+        )
+
+
 # DATADOG data
+def round_window(ts_from, ts_to, bucket):
+    """
+    Window of the same length ending at the start of the bucket of ts_to
+
+    :param ts_from: timestamp beginning of given period
+    :type ts_from: int
+    :param ts_to: timestamp end of given period
+    :type ts_to: int
+    :param bucket: seconds window ends are rounded down to
+    :type bucket: int
+    :return: rounded window
+    :rtype: Tuple[int, int]
+    """
+    end = ts_to - ts_to % max(1, bucket)
+    return end - (ts_to - ts_from), end
+
+
+class SloCache:
+    """
+    SLO history results by SLO ID and time window with TTL and LRU eviction, optionally kept in a json file.
+    Window ends are rounded down to buckets so that runs inside one bucket share the result: the overall
+    SLI of a window can't be composed from the SLIs of its parts, so overlapping windows are not merged.
+
+    :param path: json file, in memory only when not given
+    :type path: str
+    :param ttl: seconds a result is used
+    :type ttl: float
+    :param max_entries: results kept at most
+    :type max_entries: int
+    :param bucket: seconds window ends are rounded down to
+    :type bucket: int
+    """
+
+    def __init__(self, path=None, ttl=900, max_entries=10000, bucket=300):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.bucket = max(1, bucket)
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        if path and os_path.exists(path):
+            try:
+                with open(path) as cache_file:
+                    self.entries.update(loads(cache_file.read()))
+            except ValueError as error:
+                LOG.error("Ignoring broken SLO cache %s: %s", path, error)
+
+    def window(self, ts_from, ts_to):
+        """
+        Window of the same length ending at the start of the bucket of ts_to
+
+        :param ts_from: timestamp beginning of given period
+        :type ts_from: int
+        :param ts_to: timestamp end of given period
+        :type ts_to: int
+        :return: rounded window
+        :rtype: Tuple[int, int]
+        """
+        return round_window(ts_from, ts_to, self.bucket)
+
+    def get(self, slo_id, ts_from, ts_to):
+        """
+        Cached value and name, None when missing or expired
+
+        :param slo_id: SLO ID
+        :type slo_id: str
+        :param ts_from: timestamp beginning of given period
+        :type ts_from: int
+        :param ts_to: timestamp end of given period
+        :type ts_to: int
+        :return: value and name
+        :rtype: Tuple
+        """
+        key = f"{slo_id}:{ts_from}:{ts_to}"
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time() - entry[0] > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, slo_id, ts_from, ts_to, value, name):
+        """
+        Cache value and name, evicting the least recently used results
+
+        :param slo_id: SLO ID
+        :type slo_id: str
+        :param ts_from: timestamp beginning of given period
+        :type ts_from: int
+        :param ts_to: timestamp end of given period
+        :type ts_to: int
+        :param value: SLI value
+        :type value: float
+        :param name: databox name of the SLO
+        :type name: str
+        """
+        key = f"{slo_id}:{ts_from}:{ts_to}"
+        with self.lock:
+            self.entries[key] = [time(), value, name]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def save(self):
+        """
+        Write the results that have not expired to the json file
+        """
+        if not self.path:
+            return
+        now = time()
+        with self.lock:
+            live = [(key, entry) for key, entry in self.entries.items() if now - entry[0] <= self.ttl]
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as cache_file:
+            cache_file.write(dumps(OrderedDict(live)))
+        replace(temporary, self.path)
+
+
+def time_left(timeout, deadline=None):
+    """
+    Seconds allowed for a request, the timeout cut to what is left before the deadline
+
+    :param timeout: seconds allowed per request including retries
+    :type timeout: float
+    :param deadline: monotonic time, no limit when not given
+    :type deadline: float
+    :return: seconds, 0 when the deadline has passed
+    :rtype: float
+    """
+    if deadline is None:
+        return timeout
+    return max(0, min(timeout, deadline - monotonic()))
+
+
 def get_slo_id(path):
     """
     Read file with slo_ids
@@ -57,7 +325,8 @@ def get_slo_id(path):
     return result_id
 
 
-def get_slo_value(api_key, app_key, slo_id, ts_from, ts_to):
+def get_slo_value(api_key, app_key, slo_id, ts_from, ts_to, session=None, retries=3, timeout=30, cache=None,
+                  http_cache=None):
     """
     Get slo value using slo_ids for given period
 
@@ -71,32 +340,112 @@ def get_slo_value(api_key, app_key, slo_id, ts_from, ts_to):
     :type ts_from: int
     :param ts_to: timestamp end of given period
     :type ts_to: int
+    :param session: HTTP session, a new one when not given
+    :type session: Session
+    :param retries: retries of a failed request
+    :type retries: int
+    :param timeout: seconds allowed for the SLO including retries
+    :type timeout: float
+    :param cache: cache of SLO history results
+    :type cache: SloCache
+    :param http_cache: cache of responses, revalidated with the server
+    :type http_cache: HttpCache
     :return: unique value for each slo_id and name's of slo_id's
     :rtype: Tuple
     """
-    url = f"https://api.datadoghq.com/api/v1/slo/{slo_id}/history?from_ts={ts_from}&to_ts={ts_to}"
+    if cache:
+        cached = cache.get(slo_id, ts_from, ts_to)
+        if cached:
+            return cached
+    url = f"{DATADOG_API_URL}/api/v1/slo/{slo_id}/history?from_ts={ts_from}&to_ts={ts_to}"
     LOG.debug('URL for datadog GET request: %s', url)
     headers = {
         "Content-Type": "application/json",
         "DD-API-KEY": api_key,
         "DD-APPLICATION-KEY": app_key
     }
+    session = session or make_session()
+
+    def send(conditional):
+        return request_with_retry(session, "GET", url, retries, timeout, "datadog.slo_history",
+                                  headers=dict(headers, **conditional))
+
+    def parse(response):
+        overall = response.json()["data"]["overall"]
+        return overall["sli_value"], "$" + multireplace(overall["name"].lower())
+
     try:
-        req = get(url, headers=headers)
+        if http_cache:
+            result = tuple(http_cache.fetch(f"GET {url}", send, parse, "datadog.slo_history"))
+        else:
+            result = parse(send(dict()))
     except ComError as error:
         LOG.error('SLO with id %s GET error', slo_id)
         LOG.error('Could not connect to datadog: %s', error)
+    except Timeout as error:
+        LOG.error('SLO with id %s GET error', slo_id)
+        LOG.error(error)
     except HTTPError as error:
         LOG.error('SLO with id %s GET error', slo_id)
         LOG.error(error)
     else:
-        return (
-            req.json()["data"]["overall"]["sli_value"],
-            "$" + multireplace(req.json()["data"]["overall"]["name"].lower())
-        )
+        if cache:
+            cache.put(slo_id, ts_from, ts_to, *result)
+        return result
     return 0, ""
 
 
+def get_slo_values(api_key, app_key, ids, ts_from, ts_to, concurrency=8, retries=3, timeout=30, session=None,
+                   cache=None, deadline=None, http_cache=None):
+    """
+    Get slo values of all ids concurrently over one pooled session
+
+    :param api_key: api_key of datadog
+    :type api_key: str
+    :param app_key: app_key of datadog
+    :type app_key: str
+    :param ids: SLO IDs
+    :type ids: List[str]
+    :param ts_from: timestamp beginning of given period
+    :type ts_from: int
+    :param ts_to: timestamp end of given period
+    :type ts_to: int
+    :param concurrency: requests in flight at once
+    :type concurrency: int
+    :param retries: retries of a failed request
+    :type retries: int
+    :param timeout: seconds allowed per SLO including retries
+    :type timeout: float
+    :param session: HTTP session kept by the caller, a new one closed afterwards when not given
+    :type session: Session
+    :param cache: cache of SLO history results
+    :type cache: SloCache
+    :param deadline: monotonic time after which the SLOs not requested yet are skipped
+    :type deadline: float
+    :param http_cache: cache of responses, revalidated with the server
+    :type http_cache: HttpCache
+    :return: values and names in the order of ids
+    :rtype: List[Tuple]
+    """
+    own_session = session is None
+    session = session or make_session(concurrency)
+
+    def get(slo_id):
+        seconds = time_left(timeout, deadline)
+        if not seconds:
+            LOG.error('SLO with id %s skipped at the end of the time budget', slo_id)
+            return 0, ""
+        return get_slo_value(api_key, app_key, slo_id, ts_from, ts_to, session, retries, seconds, cache, http_cache)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            return list(executor.map(get, ids))
+    finally:
+        if own_session:
+            session.close()
+
+
+@lru_cache(maxsize=4096)
 def multireplace(string):
     """
     Multiple replaces in a given string
@@ -109,7 +458,18 @@ def multireplace(string):
     return string.replace(" ", "_").replace("[", "").replace("]", "")
 
 
-def push_to_databox(post_data, databox_token):
+class PushRejected(Exception):
+    """
+    Push that databox refused with a 4xx other than 429, sending it again can't succeed
+    """
+
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.status = error.response.status_code
+        self.text = error.response.text
+
+
+def push_to_databox(post_data, databox_token, session=None, retries=3, timeout=30):
     """
     Push data to databox
 
@@ -117,25 +477,190 @@ def push_to_databox(post_data, databox_token):
     :type post_data: Dict
     :param databox_token: databox auth token
     :type databox_token: str
-    :return: server response
+    :param session: HTTP session, a new one when not given
+    :type session: Session
+    :param retries: retries of a failed request
+    :type retries: int
+    :param timeout: seconds allowed for the push including retries
+    :type timeout: float
+    :return: server response, None when the push failed on a connection error, timeout, 429 or 5xx
     :rtype: Dict
+    :raises PushRejected: databox refused the data
     """
-    url = "https://push.databox.com"
     headers = {
         "Content-Type": "application/json",
         "Accept": "application/vnd.databox.v2+json"
     }
     try:
-        req = post(url, auth=HTTPBasicAuth(databox_token, ''),
-                   data=dumps(post_data), headers=headers)
+        req = request_with_retry(session or make_session(), "POST", DATABOX_PUSH_URL, retries, timeout,
+                                 "databox.push", auth=HTTPBasicAuth(databox_token, ''), data=dumps(post_data), headers=headers)
     except ComError as error:
         LOG.error('Could not connect to databox: %s', error)
     except HTTPError as error:
+        if error.response.status_code == 429 or error.response.status_code >= 500:
+            LOG.error(error)
+        else:
+            raise PushRejected(error) from error
+    except Timeout as error:
         LOG.error(error)
     else:
         return req.json()
 
 
+def make_batches(items, batch_size, batch_bytes):
+    """
+    Split metrics into batches bounded by count and encoded size
+
+    :param items: metrics
+    :type items: List[Dict]
+    :param batch_size: metrics per batch at most
+    :type batch_size: int
+    :param batch_bytes: encoded size of a batch at most, a single larger metric gets a batch of its own
+    :type batch_bytes: int
+    :return: batches
+    :rtype: List[List[Dict]]
+    """
+    batches = list()
+    batch = list()
+    size = 0
+    for item in items:
+        item_size = len(dumps(item)) + 2
+        if batch and (len(batch) >= batch_size or size + item_size > batch_bytes):
+            batches.append(batch)
+            batch = list()
+            size = 0
+        batch.append(item)
+        size += item_size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def spool_batch(spool_dir, token_env, post_data):
+    """
+    Keep a failed push on disk, the token is referenced by its environment variable only
+
+    :param spool_dir: spool directory
+    :type spool_dir: str
+    :param token_env: name of the environment variable with the databox token
+    :type token_env: str
+    :param post_data: data that failed to push
+    :type post_data: Dict
+    """
+    makedirs(spool_dir, exist_ok=True)
+    name = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}-{uuid4().hex}.json"
+    temporary = os_path.join(spool_dir, f".{name}")
+    with open(temporary, "w") as spool_file:
+        spool_file.write(dumps({"token_env": token_env, "post_data": post_data}))
+    replace(temporary, os_path.join(spool_dir, name))
+    LOG.warning("Databox push of %s metrics spooled to %s", len(post_data["data"]), name)
+
+
+def dead_letter(spool_dir, token_env, post_data, error):
+    """
+    Append a push databox rejected to the dead letter file of the spool directory, it is not replayed
+
+    :param spool_dir: spool directory
+    :type spool_dir: str
+    :param token_env: name of the environment variable with the databox token
+    :type token_env: str
+    :param post_data: data that was rejected
+    :type post_data: Dict
+    :param error: rejection
+    :type error: PushRejected
+    """
+    makedirs(spool_dir, exist_ok=True)
+    with open(os_path.join(spool_dir, DEAD_LETTER), "a") as dead_letter_file:
+        dead_letter_file.write(dumps({
+            "time": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), "token_env": token_env,
+            "status": error.status, "error": error.text, "post_data": post_data
+        }) + "\n")
+    LOG.error("Databox rejected a push of %s metrics with %s, moved to %s: %s",
+              len(post_data["data"]), error.status, DEAD_LETTER, error.text)
+
+
+def replay_spool(spool_dir, session=None, retries=3, timeout=30):
+    """
+    Push spooled batches in the order they failed, the ones pushed or rejected are removed,
+    replay stops at the first batch that fails again
+
+    :param spool_dir: spool directory
+    :type spool_dir: str
+    :param session: HTTP session
+    :type session: Session
+    :param retries: retries of a failed request
+    :type retries: int
+    :param timeout: seconds allowed per push including retries
+    :type timeout: float
+    :return: server responses
+    :rtype: List[Dict]
+    """
+    responses = list()
+    if not os_path.isdir(spool_dir):
+        return responses
+    for name in sorted(name for name in listdir(spool_dir) if name.endswith(".json") and not name.startswith(".")):
+        path = os_path.join(spool_dir, name)
+        with open(path) as spool_file:
+            record = loads(spool_file.read())
+        try:
+            response = push_to_databox(record["post_data"], getenv(record["token_env"]), session, retries, timeout)
+        except PushRejected as error:
+            dead_letter(spool_dir, record["token_env"], record["post_data"], error)
+            remove(path)
+            continue
+        if response is None:
+            LOG.error("Spooled databox push %s failed again, keeping the spool for the next run", name)
+            break
+        remove(path)
+        responses.append(response)
+    return responses
+
+
+def push_batches(post_data, token_env, session=None, batch_size=100, batch_bytes=512 * 1024, spool_dir="spool",
+                 retries=3, timeout=30):
+    """
+    Push metrics in bounded batches, a batch that still fails after retries is spooled to disk
+    together with the remaining ones, which are not tried against an unhealthy databox.
+    A batch databox rejects goes to the dead letter file instead
+
+    :param post_data: data to push
+    :type post_data: Dict
+    :param token_env: name of the environment variable with the databox token
+    :type token_env: str
+    :param session: HTTP session
+    :type session: Session
+    :param batch_size: metrics per batch at most
+    :type batch_size: int
+    :param batch_bytes: encoded size of a batch at most
+    :type batch_bytes: int
+    :param spool_dir: spool directory
+    :type spool_dir: str
+    :param retries: retries of a failed request
+    :type retries: int
+    :param timeout: seconds allowed per push including retries
+    :type timeout: float
+    :return: server responses of the batches pushed
+    :rtype: List[Dict]
+    """
+    responses = list()
+    session = session or make_session()
+    failed = False
+    for batch in make_batches(post_data["data"], batch_size, batch_bytes):
+        response = None
+        if not failed:
+            try:
+                response = push_to_databox({"data": batch}, getenv(token_env), session, retries, timeout)
+            except PushRejected as error:
+                dead_letter(spool_dir, token_env, {"data": batch}, error)
+                continue
+        if response is None:
+            failed = True
+            spool_batch(spool_dir, token_env, {"data": batch})
+        else:
+            responses.append(response)
+    return responses
+
+
 def read_json(path):
     """
     Read file with json data
@@ -157,7 +682,28 @@ def read_json(path):
     return result
 
 
-def zendesk_preview(email, token, data):
+def make_zendesk_session(email, token, pool_size=1):
+    """
+    Pooled session with the zendesk Basic-auth header built once
+
+    :param email: zendesk email
+    :type email: str
+    :param token: zendesk token
+    :type token: str
+    :param pool_size: connections kept alive
+    :type pool_size: int
+    :return: session
+    :rtype: Session
+    """
+    session = make_session(pool_size)
+    session.headers.update({
+        "Content-Type": "application/json",
+        "Authorization": "Basic " + b64encode(f"{email}/token:{token}".encode("ascii")).decode("ascii")
+    })
+    return session
+
+
+def zendesk_preview(email, token, data, session=None, retries=3, timeout=30, http_cache=None):
     """
     Show zendesk preview
 
@@ -167,27 +713,536 @@ def zendesk_preview(email, token, data):
     :type token: str
     :param data: data to push
     :type data: Dict
+    :param session: session from make_zendesk_session, a new one when not given
+    :type session: Session
+    :param retries: retries of a failed request
+    :type retries: int
+    :param timeout: seconds allowed for the preview including retries
+    :type timeout: float
+    :param http_cache: cache of responses, revalidated with the server
+    :type http_cache: HttpCache
     :return: zendesk response
     :rtype: Dict
     """
-    url = "https://thisisix.zendesk.com//api/v2/views/preview/count.json"
-    LOG.debug('URL for datadog GET request: %s', url)
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": "Basic " + b64encode(f"{email}/token:{token}".encode("ascii")).decode("ascii")
-    }
+    url = f"{ZENDESK_API_URL}/api/v2/views/preview/count.json"
+    LOG.debug('URL for zendesk POST request: %s', url)
+    session = session or make_zendesk_session(email, token)
+    body = dumps(data)
+
+    def send(conditional):
+        return request_with_retry(session, "POST", url, retries, timeout, "zendesk.view_preview", data=body,
+                                  headers=conditional)
+
     try:
-        req = post(url, data=dumps(data), headers=headers)
+        if http_cache:
+            # the same view definition is previewed on every run, the body is part of the key
+            return http_cache.fetch(f"POST {url} {dumps(data, sort_keys=True)}", send, lambda req: req.json(),
+                                    "zendesk.view_preview", "POST")
+        return send(dict()).json()
     except ComError as error:
         LOG.error('Could not connect to zendesk: %s', error)
-    except HTTPError as error:
+    except (HTTPError, Timeout) as error:
         LOG.error(error)
-    else:
-        return req.json()
     return dict()
 
 
-# TODO: JIRA SERVICE
+def poll_zendesk_views(email, token, views, concurrency=8, attempts=4, wait=0.5, retries=3, timeout=30,
+                       session=None, deadline=None, http_cache=None):
+    """
+    Preview all views at once and re-poll only the ones whose count is not fresh yet
+
+    :param email: zendesk email
+    :type email: str
+    :param token: zendesk token
+    :type token: str
+    :param views: view definitions by key, with "params" to preview
+    :type views: Dict
+    :param concurrency: previews in flight at once
+    :type concurrency: int
+    :param attempts: previews per view at most
+    :type attempts: int
+    :param wait: seconds before the first re-poll, doubled on every round
+    :type wait: float
+    :param retries: retries of a failed request
+    :type retries: int
+    :param timeout: seconds allowed per preview including retries
+    :type timeout: float
+    :param session: session from make_zendesk_session kept by the caller, a new one closed afterwards when not given
+    :type session: Session
+    :param deadline: monotonic time after which no more views are previewed
+    :type deadline: float
+    :param http_cache: cache of responses, revalidated with the server
+    :type http_cache: HttpCache
+    :return: last non-empty response by view key, views that always failed are missing
+    :rtype: Dict
+    """
+    responses = dict()
+    pending = list(views)
+    own_session = session is None
+    session = session or make_zendesk_session(email, token, concurrency)
+
+    def preview(key):
+        seconds = time_left(timeout, deadline)
+        if not seconds:
+            return dict()
+        return zendesk_preview(email, token, views[key]["params"], session, retries, seconds, http_cache)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for attempt in range(attempts):
+            if attempt:
+                delay = wait * 2 ** (attempt - 1)
+                if deadline is not None and monotonic() + delay >= deadline:
+                    LOG.warning("%s zendesk views still stale at the end of the time budget", len(pending))
+                    break
+                sleep(delay)
+            results = executor.map(preview, pending)
+            for key, response in zip(pending, results):
+                if response:
+                    responses[key] = response
+            pending = [key for key in pending if not responses.get(key, {}).get("view_count", {}).get("fresh")]
+            if not pending:
+                break
+    if own_session:
+        session.close()
+    return responses
+
+
+class ConfigFile:
+    """
+    Config file parsed again only when its modification time or size changes
+
+    :param path: path to file
+    :type path: str
+    :param loader: function parsing the file
+    :type loader: Callable
+    """
+
+    def __init__(self, path, loader):
+        self.path = path
+        self.loader = loader
+        self.signature = None
+        self.value = None
+
+    def get(self):
+        """
+        Parsed content, the last good one when the file can't be read any more
+
+        :return: parsed content
+        :rtype: Any
+        """
+        try:
+            info = stat(self.path)
+        except OSError as error:
+            if self.signature is None:
+                return self.loader(self.path)
+            LOG.error("Can't stat %s, keeping the loaded config: %s", self.path, error)
+            return self.value
+        signature = (info.st_mtime_ns, info.st_size)
+        if signature != self.signature:
+            self.value = self.loader(self.path)
+            self.signature = signature
+            LOG.info("Loaded %s", self.path)
+        return self.value
+
+
+def collect_datadog(args, ids, session=None, cache=None, deadline=None, http_cache=None):
+    """
+    SLO values of the last week as databox payload
+
+    :param args: call arguments
+    :type args: Dict
+    :param ids: SLO IDs
+    :type ids: List[str]
+    :param session: HTTP session
+    :type session: Session
+    :param cache: cache of SLO history results, the window end is rounded down to its bucket
+    :type cache: SloCache
+    :param deadline: monotonic time after which the SLOs not requested yet are skipped
+    :type deadline: float
+    :param http_cache: cache of responses, revalidated with the server
+    :type http_cache: HttpCache
+    :return: databox payload
+    :rtype: Dict
+    """
+    today = datetime.utcnow()
+    week_ago = today - timedelta(days=7)
+    ts_from, ts_to = int(week_ago.timestamp()), int(today.timestamp())
+    if cache:
+        ts_from, ts_to = cache.window(ts_from, ts_to)
+    elif http_cache:
+        # the same url is requested again within a bucket
+        ts_from, ts_to = round_window(ts_from, ts_to, args.get("slo_bucket"))
+    slo_values = get_slo_values(
+        getenv(args.get("dd_api_key")),
+        getenv(args.get("dd_app_key")),
+        ids,
+        ts_from,
+        ts_to,
+        args.get("concurrency"),
+        args.get("retries"),
+        args.get("timeout"),
+        session,
+        cache,
+        deadline,
+        http_cache
+    )
+    if cache:
+        cache.save()
+    post_data = {"data": list()}
+    for sli_value, sli_name in slo_values:
+        post_data["data"].append({"date": today.strftime('%Y-%m-%d %H:%M:%S'), sli_name: sli_value})
+    return post_data
+
+
+def collect_zendesk(args, zendesk_data, session=None, deadline=None, http_cache=None):
+    """
+    View counts summed by databox name as databox payload
+
+    :param args: call arguments
+    :type args: Dict
+    :param zendesk_data: view definitions by key
+    :type zendesk_data: Dict
+    :param session: session from make_zendesk_session
+    :type session: Session
+    :param deadline: monotonic time after which no more views are previewed
+    :type deadline: float
+    :param http_cache: cache of responses, revalidated with the server
+    :type http_cache: HttpCache
+    :return: databox payload
+    :rtype: Dict
+    """
+    today = datetime.utcnow()
+    zendesk_results = dict()
+    responses = poll_zendesk_views(
+        getenv(args.get("zen_email")),
+        getenv(args.get("zen_token")),
+        zendesk_data,
+        args.get("concurrency"),
+        args.get("zen_attempts"),
+        args.get("zen_wait"),
+        args.get("retries"),
+        args.get("timeout"),
+        session,
+        deadline,
+        http_cache
+    )
+    for key in zendesk_data:
+        response = responses.get(key)
+        if response:
+            if zendesk_results.get(zendesk_data[key]["databox_name"]):
+                zendesk_results[zendesk_data[key]["databox_name"]] += response["view_count"]["value"]
+            else:
+                zendesk_results[zendesk_data[key]["databox_name"]] = response["view_count"]["value"]
+        else:
+            LOG.error("Zendesk view %s failed", key)
+    post_data = {"data": list()}
+    for key in zendesk_results:
+        post_data["data"].append({"date": today.strftime('%Y-%m-%d %H:%M:%S'), key: zendesk_results[key]})
+    return post_data
+
+
+class Collector(ABC):
+    """
+    Source of databox metrics run by the Runtime. Subclasses name themselves after their command line flag,
+    name the argument holding the environment variable with their databox token and implement collect,
+    which should give up once the deadline is reached
+
+    :param args: call arguments
+    :type args: Dict
+    :param runtime: runtime sharing sessions and the retry policy
+    :type runtime: Runtime
+    """
+    name = None
+    token_arg = None
+    # seconds, overridden with --budget name=seconds
+    budget = 300
+
+    def __init__(self, args, runtime):
+        self.args = args
+        self.runtime = runtime
+
+    @property
+    def token_env(self):
+        return self.args.get(self.token_arg)
+
+    @abstractmethod
+    def collect(self, deadline):
+        """
+        Collect the metrics
+
+        :param deadline: monotonic time the metrics are needed by
+        :type deadline: float
+        :return: databox metrics
+        :rtype: List[Dict]
+        """
+
+
+class DatadogCollector(Collector):
+    """
+    SLO values of the last week, the SLO IDs file is read again when it changes
+    """
+    name = "datadog"
+    token_arg = "dtd_token"
+
+    def __init__(self, args, runtime):
+        super().__init__(args, runtime)
+        self.ids_file = ConfigFile(args.get("ids_file"), get_slo_id)
+        # the daemon keeps the results in memory even without a cache file
+        self.cache = make_slo_cache(args) or (
+            SloCache(None, args.get("slo_cache_ttl"), args.get("slo_cache_size"), args.get("slo_bucket"))
+            if args.get("daemon") else None
+        )
+
+    def collect(self, deadline):
+        session = self.runtime.session("datadog", lambda: make_session(self.args.get("concurrency")))
+        return collect_datadog(self.args, self.ids_file.get(), session, self.cache, deadline,
+                               self.runtime.http_cache)["data"]
+
+
+class ZendeskCollector(Collector):
+    """
+    View counts summed by databox name, the views file is read again when it changes
+    """
+    name = "zendesk"
+    token_arg = "dtz_token"
+
+    def __init__(self, args, runtime):
+        super().__init__(args, runtime)
+        self.views_file = ConfigFile(args.get("zen_json"), read_json)
+
+    def collect(self, deadline):
+        session = self.runtime.session("zendesk", lambda: make_zendesk_session(
+            getenv(self.args.get("zen_email")), getenv(self.args.get("zen_token")), self.args.get("concurrency")
+        ))
+        return collect_zendesk(self.args, self.views_file.get(), session, deadline, self.runtime.http_cache)["data"]
+
+
+# collectors by command line flag
+COLLECTORS = OrderedDict((collector.name, collector) for collector in (DatadogCollector, ZendeskCollector))
+
+
+class Runtime:
+    """
+    Runs collectors concurrently over shared pooled sessions with one retry policy, each within its
+    time budget, and pushes their metrics merged into one payload per databox token as soon as all
+    collectors of the token are done, so a run takes as long as its slowest collector
+
+    :param args: call arguments
+    :type args: Dict
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = Lock()
+        # pushes replay the spool first, one at a time so that no spooled batch is pushed twice
+        self.push_lock = Lock()
+        self.sessions = dict()
+        self.budgets = dict(args.get("budgets") or ())
+        self.databox_session = self.session("databox", make_session)
+        self.http_cache = None
+        if args.get("http_cache"):
+            self.http_cache = HttpCache(args.get("http_cache"), args.get("http_cache_size"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            sessions, self.sessions = self.sessions, dict()
+        for session in sessions.values():
+            session.close()
+        if self.http_cache:
+            self.http_cache.close()
+
+    def session(self, key, factory):
+        """
+        Session shared by everything using the key, created on first use
+
+        :param key: session name
+        :type key: str
+        :param factory: function creating the session
+        :type factory: Callable
+        :return: session
+        :rtype: Session
+        """
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = self.sessions[key] = factory()
+            return session
+
+    def budget(self, collector):
+        return self.budgets.get(collector.name, collector.budget)
+
+    def collect(self, collector, deadline):
+        started = monotonic()
+        try:
+            return collector.collect(deadline)
+        finally:
+            METRICS.observe("phase_seconds", monotonic() - started, phase=f"{collector.name}.collect")
+
+    def push(self, collectors, data):
+        names = "+".join(collector.name for collector in collectors)
+        with self.push_lock, METRICS.phase(f"{names}.push"):
+            push_payload(self.args, {"data": data}, collectors[0].token_env, self.databox_session)
+
+    def run(self, collectors):
+        """
+        Collect and push
+
+        :param collectors: collectors to run
+        :type collectors: List[Collector]
+        :return: metrics collected by collector name, None for the ones that failed or ran out of time
+        :rtype: Dict
+        """
+        started = monotonic()
+        results = dict()
+        by_token = OrderedDict()
+        for collector in collectors:
+            by_token.setdefault(collector.token_env, list()).append(collector)
+        executor = ThreadPoolExecutor(max_workers=max(1, len(collectors)))
+        deadlines = dict()
+        pending = dict()
+        for collector in collectors:
+            deadline = started + self.budget(collector)
+            future = executor.submit(self.collect, collector, deadline)
+            deadlines[future] = deadline
+            pending[future] = collector
+        try:
+            while pending:
+                done, _ = wait(pending, max(0, min(deadlines[future] for future in pending) - monotonic()),
+                               FIRST_COMPLETED)
+                for future in list(pending):
+                    collector = pending[future]
+                    if future in done:
+                        try:
+                            results[collector.name] = future.result()
+                        except Exception as error:  # pylint: disable=broad-except
+                            LOG.exception("%s collector failed: %s", collector.name, error)
+                            results[collector.name] = None
+                    elif monotonic() >= deadlines[future]:
+                        LOG.error("%s collector ran out of its %s s budget", collector.name, self.budget(collector))
+                        METRICS.count("collector_timeouts_total", collector=collector.name)
+                        results[collector.name] = None
+                    else:
+                        continue
+                    del pending[future]
+                for token_env, members in list(by_token.items()):
+                    if all(member.name in results for member in members):
+                        del by_token[token_env]
+                        data = [item for member in members for item in results[member.name] or ()]
+                        if data:
+                            self.push(members, data)
+        finally:
+            # collectors past their budget are not waited for
+            executor.shutdown(wait=False, cancel_futures=True)
+        LOG.info("%s, collected and pushed in %.3f s", ", ".join(
+            f"{name}: {len(data) if data is not None else 'failed'}" for name, data in results.items()
+        ), monotonic() - started)
+        return results
+
+
+def parse_budget(value):
+    """
+    Parse collector=seconds
+    """
+    name, _, seconds = value.partition("=")
+    if name not in COLLECTORS:
+        raise ArgumentTypeError(f"unknown collector {name}, one of {', '.join(COLLECTORS)}")
+    try:
+        return name, float(seconds)
+    except ValueError:
+        raise ArgumentTypeError(f"invalid budget {value}, expected like datadog=60") from None
+
+
+def push_payload(args, post_data, token_env, session):
+    """
+    Replay the spool, then push the payload in batches
+
+    :param args: call arguments
+    :type args: Dict
+    :param post_data: databox payload
+    :type post_data: Dict
+    :param token_env: name of the environment variable with the databox token
+    :type token_env: str
+    :param session: HTTP session
+    :type session: Session
+    """
+    for response in replay_spool(args.get("spool_dir"), session, args.get("retries"), args.get("timeout")):
+        print(response)
+    print(dumps(post_data, indent=4))
+    print(push_batches(
+        post_data,
+        token_env,
+        session,
+        args.get("batch_size"),
+        args.get("batch_bytes"),
+        args.get("spool_dir"),
+        args.get("retries"),
+        args.get("timeout")
+    ))
+
+
+def make_slo_cache(args):
+    """
+    SLO history cache kept in the file given by --slo-cache
+
+    :param args: call arguments
+    :type args: Dict
+    :return: cache, None when no file is given
+    :rtype: SloCache
+    """
+    if not args.get("slo_cache"):
+        return None
+    return SloCache(args.get("slo_cache"), args.get("slo_cache_ttl"), args.get("slo_cache_size"), args.get("slo_bucket"))
+
+
+def run_daemon(args, collectors, runtime):
+    """
+    Run every collector in its own thread on its own interval with warm sessions, until interrupted,
+    so a slow collector doesn't delay the others
+
+    :param args: call arguments
+    :type args: Dict
+    :param collectors: enabled collectors
+    :type collectors: List[Collector]
+    :param runtime: runtime sharing sessions and the retry policy
+    :type runtime: Runtime
+    """
+    stop = Event()
+    export_lock = Lock()
+
+    def loop(collector, interval):
+        while not stop.is_set():
+            started = monotonic()
+            try:
+                runtime.run([collector])
+            except Exception as error:  # pylint: disable=broad-except
+                LOG.exception("%s cycle failed: %s", collector.name, error)
+            with export_lock:
+                metrics.export(args)
+            if monotonic() - started > interval:
+                LOG.warning("%s cycle took longer than its %s s interval", collector.name, interval)
+            stop.wait(max(0, started + interval - monotonic()))
+
+    threads = [
+        Thread(target=loop, args=(collector, args.get(f"{collector.name}_interval") or 60),
+               name=f"{collector.name}-collector", daemon=True)
+        for collector in collectors
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            # joined with a timeout so that the main thread still sees KeyboardInterrupt
+            for thread in threads:
+                thread.join(1)
+    except KeyboardInterrupt:
+        stop.set()
+        LOG.info("Stopped")
 
 
 def main():
@@ -198,58 +1253,15 @@ def main():
     :rtype: int
     """
     args = get_arguments()
-    api_key = getenv(args.get("dd_api_key"))
-    app_key = getenv(args.get("dd_app_key"))
-    zen_email = getenv(args.get("zen_email"))
-    zen_token = getenv(args.get("zen_token"))
-    databox_token_datadog = getenv(args.get("dtd_token"))
-    databox_token_zendesk = getenv(args.get("dtz_token"))
-    today = datetime.utcnow()
-    post_data = dict()
-    if args.get("datadog"):
-        post_data["datadog"] = dict()
-        post_data["datadog"]["data"] = list()
-        ids = get_slo_id(args.get("ids_file"))
-        week_ago = today - timedelta(days=7)
-        for slo_id in ids:
-            sli_value, sli_name = get_slo_value(
-                api_key,
-                app_key,
-                slo_id,
-                int(week_ago.timestamp()),
-                int(today.timestamp())
-            )
-            post_data["datadog"]["data"].append({"date": today.strftime('%Y-%m-%d %H:%M:%S'), sli_name: sli_value})
-    if args.get("zendesk"):
-        post_data["zendesk"] = dict()
-        post_data["zendesk"]["data"] = list()
-        zendesk_data = read_json(args.get("zen_json"))
-        zendesk_results = dict()
-        for key in zendesk_data:
-            response = dict()
-            count = 0
-            while not response.get("view_count", {}).get("fresh"):
-                response = zendesk_preview(zen_email, zen_token, zendesk_data[key]["params"])
-                if count < 3:
-                    count += 1
-                    sleep(1)
-                else:
-                    break
-            if response:
-                if zendesk_results.get(zendesk_data[key]["databox_name"]):
-                    zendesk_results[zendesk_data[key]["databox_name"]] += response["view_count"]["value"]
-                else:
-                    zendesk_results[zendesk_data[key]["databox_name"]] = response["view_count"]["value"]
-            else:
-                LOG.error("Zendesk view %s failed", key)
-        for key in zendesk_results:
-            post_data["zendesk"]["data"].append({"date": today.strftime('%Y-%m-%d %H:%M:%S'), key: zendesk_results[key]})
-    if args.get("datadog"):
-        print(dumps(post_data["datadog"], indent=4))
-        print(push_to_databox(post_data["datadog"], databox_token_datadog))
-    if args.get("zendesk"):
-        print(dumps(post_data["zendesk"], indent=4))
-        print(push_to_databox(post_data["zendesk"], databox_token_zendesk))
+    metrics.setup("inte", args)
+    if args.get("daemon"):
+        basicConfig(level=INFO, format='%(asctime)s %(levelname)8s: %(message)s')
+    with Runtime(args) as runtime:
+        collectors = [collector(args, runtime) for name, collector in COLLECTORS.items() if args.get(name)]
+        if args.get("daemon"):
+            run_daemon(args, collectors, runtime)
+        elif collectors:
+            runtime.run(collectors)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+"""
+Totals of both engines against a row by row sum, across chunk sizes and appends to a resumed file
+"""
+from datetime import date
+from importlib.util import find_spec
+from math import isnan
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main, skipUnless
+import sys
+sys.path.append(str(Path(__file__).resolve().parent))
+from parser import record_history, sum_file, sum_files, sum_incremental  # noqa: E402
+
+HEADER = 'a,b,c,Org,e,Live Indexed\n'
+ROWS = [
+    ('A', '0.1'), ('B', '7'), ('A', '0.2'), ('B', '5'), ('A', '0.30000000000000004'),
+    ('C', '1.2345678901234567e3'), ('C', '98765.43210987654'), ('A', '1e-320'), ('C', '0.12345678901234567'),
+]
+CHUNK_SIZES = (0, 1, 2, 1000)
+
+
+def line(org, value):
+    return f'1,2,3,{org},5,{value}\n'
+
+
+def row_sums(path):
+    """
+    Totals of the row by row loop over a full pandas read the parser replaced
+    """
+    import pandas as pd
+    totals = dict()
+    for _, row in pd.read_csv(path, usecols=[3, 5]).iterrows():
+        totals[row['Org']] = totals.get(row['Org'], 0) + row['Live Indexed']
+    return totals
+
+
+class EngineTest(TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, rows, mode='w'):
+        path = str(Path(self.directory.name) / name)
+        with open(path, mode) as handle:
+            if mode == 'w':
+                handle.write(HEADER)
+            handle.writelines(line(org, value) for org, value in rows)
+        return path
+
+    def test_totals_match_row_by_row_sum(self):
+        path = self.write('logs.csv', ROWS)
+        expected = row_sums(path)
+        for engine in ('csv', 'pandas'):
+            for chunk_size in CHUNK_SIZES:
+                with self.subTest(engine=engine, chunk_size=chunk_size):
+                    totals = sum_file(path, chunk_size, engine)
+                    self.assertEqual(list(totals), list(expected))
+                    self.assertEqual(totals, expected)
+
+    def test_missing_value_makes_total_nan(self):
+        path = self.write('logs.csv', [('B', '1'), ('B', ''), ('A', '2'), ('B', '3')])
+        for engine in ('csv', 'pandas'):
+            for chunk_size in CHUNK_SIZES:
+                with self.subTest(engine=engine, chunk_size=chunk_size):
+                    totals = sum_file(path, chunk_size, engine)
+                    self.assertTrue(isnan(totals['B']))
+                    self.assertEqual(repr(totals['A']), '2.0')
+
+    def test_integers_stay_integers(self):
+        path = self.write('logs.csv', [('101', '71'), ('', '3'), ('101', '58')])
+        for engine in ('csv', 'pandas'):
+            with self.subTest(engine=engine):
+                totals = sum_file(path, 1, engine)
+                self.assertEqual(totals['101'], 129)
+                self.assertIsInstance(totals['101'], int)
+
+    def test_append_keeps_numeric_and_missing_orgs(self):
+        rows = [('101', '5'), ('', '1'), ('202', '2')]
+        path = self.write('logs.csv', rows)
+        state = str(Path(self.directory.name) / 'state.db')
+        for engine in ('csv', 'pandas'):
+            with self.subTest(engine=engine):
+                Path(state).unlink(missing_ok=True)
+                path = self.write('logs.csv', rows)
+                sum_incremental([path], 0, 1, state, engine=engine)
+                self.write('logs.csv', [('101', '7'), ('', '2')], 'a')
+                totals = sum_incremental([path], 0, 1, state, engine=engine)
+                self.assertEqual([str(org) for org in totals], ['101', 'nan', '202'])
+                self.assertEqual([totals['101'], totals['202']], [12, 2])
+                self.assertEqual(sum(1 for org in totals if org != org), 1)
+
+    @skipUnless(find_spec('pyarrow'), 'history needs pyarrow')
+    def test_history_replaces_head_of_grown_file(self):
+        from common.history import query
+        root = str(Path(self.directory.name) / 'history')
+        day = date(2026, 10, 1)
+        path = self.write('logs.csv', [('A', '1')] * 100)
+        for rows in ([], [('A', '1')] * 100):
+            self.write('logs.csv', rows, 'a')
+            parsed = list()
+            sum_files([path], 0, 1, parsed)
+            record_history(root, day, parsed)
+        self.assertEqual(query(root, 'usage', ['org']), [{'org': 'A', 'live_indexed': 200.0}])
+
+
+if __name__ == '__main__':
+    main()
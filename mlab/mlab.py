@@ -1,31 +1,326 @@
-from re import compile as re_comp, I
+from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from csv import writer as csv_writer
+from datetime import date, datetime, timezone
+from json import dump
+from operator import itemgetter
+from pathlib import Path
+from re import compile as re_comp, I, M
 from typing import Dict
-from sys import exit as sys_exit
+from sys import exit as sys_exit, path as sys_path
+sys_path.append(str(Path(__file__).resolve().parents[1]))
+from common import metrics  # noqa: E402
+from common.checkpoint import Checkpoint, complete_end  # noqa: E402
+from common.metrics import METRICS  # noqa: E402
+
+# multiline so that one findall call scans a whole block, lines with another environment prefix
+# are rejected by the anchored alternation without any python code running for them
+LINE_RE = re_comp(rb'^(dev|prod|uat|qa)-(projects1/projects2/projects3).* - 0*(\d+)\r?$', I | M)
+GIB = 1024 * 1024 * 1024
+BLOCK_SIZE = 16 * 1024 * 1024
+REPORT = 'report.txt'
+SUMMARY = 'summaryOfproject.txt'
+DIMENSIONS = ('env', 'project')
+FORMATS = ('txt', 'csv', 'json', 'parquet')
+LEADING_DIGITS = itemgetter(slice(0, 2))
+
+
+class SizeStats:
+    """
+    Count, total, min, max and a histogram of sizes by length and two leading digits,
+    mergeable across groups, worker processes and runs
+    """
+    __slots__ = ('count', 'total', 'minimum', 'maximum', 'buckets')
+
+    def __init__(self, count=0, total=0, minimum=None, maximum=None, buckets=None):
+        self.count = count
+        self.total = total
+        self.minimum = minimum
+        self.maximum = maximum
+        self.buckets: Dict = buckets or dict()
+
+    def update(self, sizes, histogram=True):
+        """
+        Add a batch of sizes given as digit strings, the per size work runs in C builtins,
+        the histogram is only needed for percentiles
+        """
+        values = list(map(int, sizes))
+        self.merge(SizeStats(len(values), sum(values), min(values), max(values)))
+        if not histogram:
+            return
+        for (length, leading), count in Counter(zip(map(len, sizes), map(LEADING_DIGITS, sizes))).items():
+            bucket = length * 100 + int(leading)
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        if other.minimum is not None and (self.minimum is None or other.minimum < self.minimum):
+            self.minimum = other.minimum
+        if other.maximum is not None and (self.maximum is None or other.maximum > self.maximum):
+            self.maximum = other.maximum
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        return self
+
+    def percentile(self, percent):
+        """
+        Approximate percentile, middle of the bucket the rank falls into
+        """
+        if not self.count:
+            return None
+        rank = max(1, -(-self.count * percent // 100))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                break
+        length, leading = divmod(bucket, 100)
+        if length <= 2:
+            return leading
+        scale = 10 ** (length - 2)
+        return min(max(leading * scale + scale // 2, self.minimum), self.maximum)
+
+    def dump(self):
+        return [self.count, self.total, self.minimum, self.maximum, list(self.buckets.items())]
+
+    @classmethod
+    def load(cls, values):
+        count, total, minimum, maximum, buckets = values
+        return cls(count, total, minimum, maximum, dict(buckets))
+
+
+def get_arguments():
+    parser = ArgumentParser()
+    parser.add_argument('-i', '--input', dest='input', type=str, default=REPORT)
+    parser.add_argument('-o', '--output', dest='output', type=str, default=SUMMARY)
+    parser.add_argument('-g', '--group-by', dest='group_by', type=str, action='append',
+                        help=f'comma separated dimensions out of {",".join(DIMENSIONS)}, repeat for several '
+                             'breakdowns, default project')
+    parser.add_argument('-F', '--format', dest='format', type=str, choices=FORMATS, default='txt')
+    parser.add_argument('-p', '--percentiles', dest='percentiles', type=str, default='50,90,99')
+    parser.add_argument('-s', '--state', dest='state', type=str, default=None,
+                        help='state file, parse only lines appended since the previous run')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                        help='processes scanning parts of the report split at line boundaries')
+    parser.add_argument('--history', dest='history', type=str, default=None,
+                        help='history directory, adds the scanned sizes as a day partition, needs pyarrow')
+    parser.add_argument('--history-day', dest='history_day', type=date.fromisoformat,
+                        default=datetime.now(timezone.utc).date(),
+                        help='day the scanned lines belong to in the history, YYYY-MM-DD, default today (UTC)')
+    metrics.add_arguments(parser)
+    args = vars(parser.parse_args())
+    group_by = list()
+    for spec in args.get('group_by') or ['project']:
+        dimensions = tuple(dimension.strip() for dimension in spec.split(','))
+        unknown = set(dimensions) - set(DIMENSIONS)
+        if unknown:
+            parser.error(f'unknown dimensions {", ".join(sorted(unknown))} in --group-by {spec}')
+        group_by.append(dimensions)
+    args['group_by'] = group_by
+    args['percentiles'] = [float(percent) for percent in args.get('percentiles').split(',') if percent]
+    return args
+
+
+def scan_range(path, start=0, end=None, histogram=True):
+    """
+    Size stats per environment and project of lines between start and end offsets, read in large blocks
+    """
+    table: Dict = dict()
+    with open(path, 'rb') as report:
+        if end is None:
+            end = report.seek(0, 2)
+        report.seek(start)
+        position = start
+        tail = b''
+        while position < end:
+            block = report.read(min(BLOCK_SIZE, end - position))
+            if not block:
+                break
+            position += len(block)
+            block = tail + block
+            cut = block.rfind(b'\n') + 1 if position < end else len(block)
+            groups: Dict = dict()
+            for env, project, size in LINE_RE.findall(memoryview(block)[:cut]):
+                sizes = groups.get((env, project))
+                if sizes is None:
+                    sizes = groups[(env, project)] = list()
+                sizes.append(size)
+            for key, sizes in groups.items():
+                table.setdefault(key, SizeStats()).update(sizes, histogram)
+            tail = block[cut:]
+    return table
+
+
+def split_ranges(path, start, end, parts):
+    """
+    Split offsets between start and end into up to parts ranges at line boundaries
+    """
+    bounds = [start]
+    with open(path, 'rb') as report:
+        for part in range(1, parts):
+            report.seek(max(start + (end - start) * part // parts - 1, bounds[-1]))
+            report.readline()
+            if bounds[-1] < report.tell() < end:
+                bounds.append(report.tell())
+    bounds.append(end)
+    return list(zip(bounds, bounds[1:]))
+
+
+def scan(path, data: Dict, start=0, end=None, workers=1, histogram=True):
+    """
+    Add size stats per (env, project) of lines between start and end offsets to data,
+    sizes are kept in bytes so totals stay exact across incremental runs. Environments
+    are lower cased, prod and PROD are one environment
+    """
+    if end is None:
+        end = Path(path).stat().st_size
+    ranges = split_ranges(path, start, end, workers) if workers > 1 else [(start, end)]
+    if len(ranges) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            partials = list(executor.map(scan_range, [path] * len(ranges), *zip(*ranges),
+                                         [histogram] * len(ranges)))
+    else:
+        partials = [scan_range(path, start, end, histogram)]
+    for table in partials:
+        for (env, project), stats in table.items():
+            key = (env.decode().lower(), project.decode())
+            if key in data:
+                data[key].merge(stats)
+            else:
+                data[key] = stats
+    return data
+
+
+def rollup(data: Dict, dimensions):
+    """
+    Merge (env, project) stats into the breakdown by the given dimensions
+    """
+    indexes = [DIMENSIONS.index(dimension) for dimension in dimensions]
+    result: Dict = dict()
+    for key, stats in data.items():
+        group = tuple(key[index] for index in indexes)
+        result.setdefault(group, SizeStats()).merge(stats)
+    return result
+
+
+def report_rows(data: Dict, group_by, percentiles):
+    """
+    Flat rows of every breakdown
+    """
+    rows = list()
+    for dimensions in group_by:
+        for group, stats in rollup(data, dimensions).items():
+            row = {'group_by': ','.join(dimensions)}
+            row.update((dimension, group[dimensions.index(dimension)] if dimension in dimensions else None)
+                       for dimension in DIMENSIONS)
+            row.update(count=stats.count, total_bytes=stats.total, total_gib=stats.total / GIB,
+                       min_bytes=stats.minimum, max_bytes=stats.maximum)
+            row.update((f'p{percent:g}_bytes', stats.percentile(percent)) for percent in percentiles)
+            rows.append(row)
+    return rows
+
+
+def write_report(path, data: Dict, group_by, output_format, percentiles):
+    """
+    Write breakdowns as plain text, csv, json or parquet
+    """
+    if output_format == 'txt':
+        with open(path, 'w') as summary_of_project:
+            for dimensions in group_by:
+                if len(group_by) > 1:
+                    summary_of_project.write(f'# {",".join(dimensions)}\n')
+                for group, stats in rollup(data, dimensions).items():
+                    summary_of_project.write(f'{" ".join(group)} {stats.total / GIB}\n')
+        return
+    rows = report_rows(data, group_by, percentiles)
+    if output_format == 'csv':
+        with open(path, 'w', newline='') as summary_of_project:
+            writer = csv_writer(summary_of_project)
+            if rows:
+                writer.writerow(rows[0])
+            writer.writerows(row.values() for row in rows)
+    elif output_format == 'json':
+        result: Dict = dict()
+        for row in rows:
+            result.setdefault(row.pop('group_by'), list()).append(row)
+        with open(path, 'w') as summary_of_project:
+            dump(result, summary_of_project, indent=4)
+    else:
+        try:
+            import pandas as pd
+        except ImportError as err:
+            print('Parquet output needs pandas and pyarrow: ', err)
+            sys_exit(3)
+        pd.DataFrame(rows).to_parquet(path, index=False)
+
+
+def record_history(root, day, path, start, end, data: Dict):
+    """
+    Add the sizes scanned between start and end to the day in the storage history,
+    scanning the same range again replaces their rows
+    """
+    from common.history import source_range, write_part
+    keys = sorted(data)
+    return write_part(root, 'storage', day, {
+        'env': [env for env, _ in keys], 'project': [project for _, project in keys],
+        'count': [data[key].count for key in keys], 'total_bytes': [data[key].total for key in keys],
+        'min_bytes': [data[key].minimum for key in keys], 'max_bytes': [data[key].maximum for key in keys],
+    }, [source_range(path, start, end)])
+
 
- 
- 
 def main():
-    line_re = re_comp(r'^(dev|prod|uat|qa)-(projects1/projects2/projects3).* - (\d+)$', I)
+    args = get_arguments()
+    metrics.setup('mlab', args)
+    source = args.get('input')
+    # histograms are only read for the percentiles of csv, json and parquet, the state keeps them
+    # for any later run
+    histogram = bool(args.get('percentiles')) and (args.get('format') != 'txt' or bool(args.get('state')))
     data: Dict = dict()
+    # sizes of the lines scanned by this run only, what goes to the history
+    scanned: Dict = dict()
     try:
-        with open('report.txt') as report:
-            for line in report:
-                match = line_re.match(line)
-                if match:
-                    if match.group(2) in data:
-                        data[match.group(2)] += float(match.group(3)) / 1024 / 1024 / 1024
-                    else:
-                        data[match.group(2)] = float(match.group(3)) / 1024 / 1024 / 1024
+        if args.get('state'):
+            with Checkpoint(args.get('state'), 'mlab') as checkpoint:
+                offset, saved = checkpoint.resume(source)
+                end = complete_end(source)
+                # states written before environments were lower cased may hold prod and PROD apart
+                for env, project, stats in saved or list():
+                    key = (env.lower(), project)
+                    data[key] = data[key].merge(SizeStats.load(stats)) if key in data else SizeStats.load(stats)
+                with METRICS.phase('scan'):
+                    scan(source, scanned, offset, end, args.get('workers'), histogram)
+                for key, stats in scanned.items():
+                    data[key] = data[key].merge(stats) if key in data else stats
+                checkpoint.save(source, end, [[*key, stats.dump()] for key, stats in data.items()])
+        else:
+            offset = 0
+            end = Path(source).stat().st_size
+            with METRICS.phase('scan'):
+                data = scanned = scan(source, scanned, workers=args.get('workers'), histogram=histogram)
+        METRICS.count('scanned_bytes_total', end - offset)
+        METRICS.count('matched_lines_total', sum(stats.count for stats in scanned.values()))
     except OSError as err:
-        print('Could not open/read file report.txt: ', err)
+        print(f'Could not open/read file {source}: ', err)
         sys_exit(1)
+    if args.get('history') and end > offset:
+        try:
+            with METRICS.phase('history'):
+                record_history(args.get('history'), args.get('history_day'), source, offset, end, scanned)
+        except ImportError as err:
+            print('History needs pyarrow: ', err)
+            sys_exit(3)
+        except OSError as err:
+            print(f'Could not write the history to {args.get("history")}: ', err)
+            sys_exit(2)
     try:
-        with open('summaryOfproject.txt', 'w') as summary_of_project:
-            for proj in data:
-                summary_of_project.write(f'{proj} {data[proj]}\n')
+        with METRICS.phase('write_report'):
+            write_report(args.get('output'), data, args.get('group_by'), args.get('format'), args.get('percentiles'))
     except OSError as err:
-        print('Could not open/write file summaryOfproject.txt: ', err)
+        print(f'Could not open/write file {args.get("output")}: ', err)
         sys_exit(2)
- 
+
+
 if __name__ == '__main__':
     main()
@@ -1,71 +1,147 @@
 """
 Batch rename of Slack channels
 """
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from json import dumps
+from os import devnull, environ
+from pathlib import Path
 from re import fullmatch
-from requests import get, post, Timeout, TooManyRedirects, RequestException
+from threading import Lock
+from time import monotonic
 import sys
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common import metrics  # noqa: E402
+from common.journal import Journal, read_jsonl  # noqa: E402
+from common.slack_client import SlackClient, SlackError, TIER_2  # noqa: E402
 TOKEN = ''
-SLACK_API_URL = 'https://slack.com/api'
 
 
 # --------------------------------------------------------------------------------------------------
-def create_list():
+def get_arguments():
     """
-    Create list of channels
+    Get command line arguments
     """
-    result = list()
-
-    def slack_get(url, shift=None):
-        ch_list = list()
-        if shift:
-            url += f'&cursor={shift}'
-        try:
-            response = get(url)
-        except Timeout:
-            print('Connection timeout')
-        except TooManyRedirects:
-            print(f'Too many redirects. Check URL: {url}')
-        except RequestException as error:
-            print(f'{url}\n{error}')
-        except ValueError as error:
-            print(f'Malformed JSON: {error}')
-        else:
-            if response.status_code == 200:
-                result = response.json()
-                next_cursor = result['response_metadata']['next_cursor']
-                ch_list = [(x['name'], x['id']) for x in result['channels']]
-        return ch_list, next_cursor
-    
-    url = f'{SLACK_API_URL}/conversations.list?token={TOKEN}&exclude_archived=true&types=public_channel,private_channel&limit=1000'
-    channels, shift = slack_get(url)
-    result += channels
-    while shift:
-        channels, shift = slack_get(url, shift)
-        result += channels
-    return result
+    parser = ArgumentParser()
+    parser.add_argument('-t', '--token', dest='token', type=str, default=environ.get('SLACK_TOKEN', TOKEN),
+                        help='slack token, defaults to the SLACK_TOKEN environment variable')
+    parser.add_argument('-p', '--plan', dest='plan', type=str, default=None,
+                        help='plan file, written by a dry run and executed with --apply')
+    parser.add_argument('--apply', dest='apply', action='store_true',
+                        help='rename the channels, from the plan file when it exists')
+    parser.add_argument('-j', '--journal', dest='journal', type=str, default='renames.jsonl',
+                        help='journal of finished renames, channels in it are skipped when resuming')
+    parser.add_argument('-c', '--concurrency', dest='concurrency', type=int, default=4,
+                        help='renames in flight')
+    parser.add_argument('-r', '--rate', dest='rate', type=float, default=TIER_2,
+                        help='renames per minute, the Tier 2 limit by default')
+    parser.add_argument('--retries', dest='retries', type=int, default=5,
+                        help='attempts after a 429 or a connection error')
+    parser.add_argument('--http2', dest='http2', action='store_true',
+                        help='send all calls over one HTTP/2 connection, needs httpx[http2]')
+    metrics.add_arguments(parser)
+    return vars(parser.parse_args())
+
+
+# --------------------------------------------------------------------------------------------------
+def create_list(client):
+    """
+    Stream channels as (name, id)
+    """
+    channels = client.paginate('conversations.list', 'channels', exclude_archived='true',
+                               types='public_channel,private_channel', limit=1000)
+    for channel in channels:
+        yield channel['name'], channel['id']
 
 
 # --------------------------------------------------------------------------------------------------
-def rename_channel(channel_id, new_name):
+def make_plan(channels):
+    """
+    Renames of the og- channels to ix-
+
+    :param channels: channel names and ids
+    :type channels: Iterable[Tuple[str, str]]
+    :return: planned renames with channel id, old and new name
+    :rtype: Iterator[Dict]
+    """
+    for name, channel_id in channels:
+        if fullmatch('^og-.*$', name):
+            yield {'id': channel_id, 'old': name, 'new': 'ix' + name[len('og'):]}
+
+
+# --------------------------------------------------------------------------------------------------
+def rename_channel(client, channel_id, new_name):
     """
     POST request to rename channel
+
+    :param client: slack client
+    :type client: SlackClient
+    :param channel_id: channel id
+    :type channel_id: str
+    :param new_name: new channel name
+    :type new_name: str
+    :return: slack error, None on success
+    :rtype: str
+    """
+    try:
+        client.call('conversations.rename', channel=channel_id, name=new_name)
+    except SlackError as error:
+        return error.error
+    return None
+
+
+# --------------------------------------------------------------------------------------------------
+def apply_plan(plan, args):
+    """
+    Run the renames concurrently, appending every result to the journal and skipping
+    the channels it already has as renamed
+
+    :param plan: planned renames
+    :type plan: List[Dict]
+    :param args: command line arguments
+    :type args: Dict
+    :return: statistics
+    :rtype: Dict
+    """
+    lock = Lock()
+    started = monotonic()
+    with make_client(args) as client, Journal(args.get('journal')) as journal:
+        done = {key for key, entry in journal.latest().items() if entry.get('ok')}
+        todo = [rename for rename in plan if rename['id'] not in done]
+        stats = {'planned': len(plan), 'skipped': len(plan) - len(todo), 'renamed': 0, 'failed': 0, 'errors': {}}
+        client.limit('conversations.rename', args.get('rate'), max(1, args.get('concurrency')))
+
+        def run(rename):
+            error = rename_channel(client, rename['id'], rename['new'])
+            journal.write(**rename, ok=error is None, error=error)
+            with lock:
+                if error is None:
+                    stats['renamed'] += 1
+                    print(f"{rename['old']} -> {rename['new']}")
+                else:
+                    stats['failed'] += 1
+                    stats['errors'][error] = stats['errors'].get(error, 0) + 1
+                    print(f"{rename['old']} -> {rename['new']} failed: {error}")
+
+        with ThreadPoolExecutor(max_workers=max(1, args.get('concurrency'))) as executor:
+            list(executor.map(run, todo))
+        stats['calls'] = client.stats
+    stats['seconds'] = round(monotonic() - started, 2)
+    stats['per_minute'] = round(stats['renamed'] * 60 / stats['seconds'], 1) if stats['seconds'] else None
+    return stats
+
+
+# --------------------------------------------------------------------------------------------------
+def make_client(args):
+    """
+    Slack client for the command line arguments
     """
-    url = f'{SLACK_API_URL}/channels.rename?token={TOKEN}&channel={channel_id}&name={new_name}'
     try:
-        response = post(url)
-    except Timeout:
-        print('Connection timeout')
-    except TooManyRedirects:
-        print(f'Too many redirects. Check URL: {url}')
-    except RequestException as error:
-        print(f'{url}\n{error}')
-    except ValueError as error:
-        print(f'Malformed JSON: {error}')
-    else:
-        if response.status_code == 200:
-            return True
-    return False
+        return SlackClient(args.get('token'), pool_size=max(1, args.get('concurrency')), retries=args.get('retries'),
+                           http2=args.get('http2'))
+    except ImportError as error:
+        print('HTTP/2 needs httpx[http2]: ', error)
+        sys.exit(3)
 
 
 # --------------------------------------------------------------------------------------------------
@@ -73,13 +149,29 @@ def main():
     """
     Main function
     """
-    data = create_list()
-    for channel in data:
-        if fullmatch('^og-.*$', channel[0]):
-            new_name = 'ix' + channel[0].lstrip('og')
-            print(f'{channel[0]} -> {new_name}') # just output with no action
-           #rename_channel(channel[1], new_name) # uncomment in order to take action
-
+    args = get_arguments()
+    metrics.setup('slack_channels', args)
+    plan_path = args.get('plan')
+    try:
+        if args.get('apply') and plan_path and Path(plan_path).exists():
+            plan = read_jsonl(plan_path)
+        elif args.get('apply'):
+            with make_client(args) as client:
+                plan = list(make_plan(create_list(client)))
+        else:
+            with make_client(args) as client, open(plan_path or devnull, 'w') as plan_file:
+                # renames are printed while the next page of channels is being fetched
+                for rename in make_plan(create_list(client)):
+                    print(f"{rename['old']} -> {rename['new']}")  # just output with no action
+                    plan_file.write(dumps(rename) + '\n')
+            return
+    except SlackError as error:
+        print(error)
+        sys.exit(1)
+    stats = apply_plan(plan, args)
+    print(dumps(stats))
+    if stats['failed']:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -1,85 +1,254 @@
 """
 Change Slack user emails
 """
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor
 from json import dumps
-from requests import get, post, Timeout, TooManyRedirects, RequestException
+from os import environ
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+import sys
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common import metrics  # noqa: E402
+from common.journal import Journal  # noqa: E402
+from common.slack_client import SlackClient, SlackError, TIER_3  # noqa: E402
 TOKEN = ''
-SLACK_API_URL = 'https://slack.com/api'
- 
- 
+DOMAIN_MAP = ['omnigon.com=ix.co']
+
+
 # --------------------------------------------------------------------------------------------------
-def create_list():
+def parse_rule(value):
     """
-   Create list of users (name,id,email)
-   """
-    result = list()
-    def slack_get(url, shift=None):
-        user_emails = list()
-        if shift:
-            url += f'&cursor={shift}'
-        try:
-            response = get(url)
-        except Timeout:
-            print('Connection timeout')
-        except TooManyRedirects:
-            print(f'Too many redirects. Check URL: {url}')
-        except RequestException as error:
-            print(f'{url}\n{error}')
-        except ValueError as error:
-            print(f'Malformed JSON: {error}')
-        else:
-            if response.status_code == 200:
-                result = response.json()
-                next_cursor = result['response_metadata']['next_cursor']
-                user_emails = [(x['id'], x['profile']['email']) 
-                              for x in result['members'] if x['profile'].get('email')]
-        return user_emails, next_cursor
- 
-    url = f'{SLACK_API_URL}/users.list?token={TOKEN}&limit=1000'
-    emails, shift = slack_get(url)
-    result += emails
-    while shift:
-        emails, shift = slack_get(url, shift)
-        result += emails
-    return result
- 
+    Parse old.domain=new.domain
+    """
+    old, _, new = value.partition('=')
+    if not old or not new or '@' in old + new:
+        raise ArgumentTypeError(f'invalid domain mapping {value}, expected like omnigon.com=ix.co')
+    return old.lower(), new
+
+
+# --------------------------------------------------------------------------------------------------
+def get_arguments():
+    """
+    Get command line arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument('-t', '--token', dest='token', type=str, default=environ.get('SLACK_TOKEN', TOKEN),
+                        help='slack token, defaults to the SLACK_TOKEN environment variable')
+    parser.add_argument('-m', '--map', dest='rules', type=parse_rule, action='append',
+                        help=f'domain mapping, repeat for several domains, default {DOMAIN_MAP[0]}')
+    parser.add_argument('--apply', dest='apply', action='store_true',
+                        help='change the emails, only print the changes otherwise')
+    parser.add_argument('--rollback', dest='rollback', action='store_true',
+                        help='restore the emails changed according to the journal')
+    parser.add_argument('--verify', dest='verify', action='store_true',
+                        help='only check the emails against the journal')
+    parser.add_argument('-j', '--journal', dest='journal', type=str, default='emails.jsonl',
+                        help='journal of changed emails, users in it are skipped when resuming')
+    parser.add_argument('-c', '--concurrency', dest='concurrency', type=int, default=4,
+                        help='changes in flight')
+    parser.add_argument('-r', '--rate', dest='rate', type=float, default=TIER_3,
+                        help='changes per minute, the Tier 3 limit of users.profile.set by default')
+    parser.add_argument('--retries', dest='retries', type=int, default=5,
+                        help='attempts after a 429 or a connection error')
+    parser.add_argument('--http2', dest='http2', action='store_true',
+                        help='send all calls over one HTTP/2 connection, needs httpx[http2]')
+    metrics.add_arguments(parser)
+    args = vars(parser.parse_args())
+    args['rules'] = args.get('rules') or [parse_rule(rule) for rule in DOMAIN_MAP]
+    return args
+
+
 # --------------------------------------------------------------------------------------------------
-def change_user_email(user_id, new_email):
+def compile_rules(rules):
     """
-   POST request to rename user
+    Email rewriting function for domain mapping rules, the domain is matched as a whole
+    and case insensitive
+
+    :param rules: old and new domains
+    :type rules: List[Tuple[str, str]]
+    :return: function returning the new email or None when no rule applies
+    :rtype: Callable
+    """
+    domains = dict(rules)
+
+    def rewrite(email):
+        local, at, domain = email.rpartition('@')
+        new_domain = domains.get(domain.lower()) if at else None
+        return f'{local}@{new_domain}' if new_domain else None
+
+    return rewrite
+
+
+# --------------------------------------------------------------------------------------------------
+def create_list(client):
+    """
+    Stream users with an email as (id, email)
+    """
+    for user in client.paginate('users.list', 'members', limit=1000):
+        if user['profile'].get('email'):
+            yield user['id'], user['profile']['email']
+
+
+# --------------------------------------------------------------------------------------------------
+def change_user_email(client, user_id, new_email):
+    """
+   POST request to rename user, returns the slack error or None on success
    """
     data = {
         "email": new_email
     }
-    url = f'{SLACK_API_URL}/users.profile.set?token={TOKEN}&user={user_id}&profile={dumps(data)}'
     try:
-        response = post(url)
-        print(response.status_code)
-        print(response.text)
-    except Timeout:
-        print('Connection timeout')
-    except TooManyRedirects:
-        print(f'Too many redirects. Check URL: {url}')
-    except RequestException as error:
-        print(f'{url}\n{error}')
-    except ValueError as error:
-        print(f'Malformed JSON: {error}')
-    else:
-        if response.status_code == 200:
-            return True
-    return False
- 
- 
+        client.call('users.profile.set', user=user_id, profile=dumps(data))
+    except SlackError as error:
+        return error.error
+    return None
+
+
+# --------------------------------------------------------------------------------------------------
+def succeeded(entry):
+    return bool(entry.get('ok'))
+
+
+# --------------------------------------------------------------------------------------------------
+def migration_changes(users, journal, rewrite):
+    """
+    Changes of the users whose email is not migrated yet, a user is skipped when the last successful
+    change in the journal already set the new email
+
+    :param users: user ids and current emails
+    :type users: Iterable[Tuple[str, str]]
+    :param journal: journal
+    :type journal: Journal
+    :param rewrite: email rewriting function
+    :type rewrite: Callable
+    :return: user id, current and new email
+    :rtype: Iterator[Tuple[str, str, str]]
+    """
+    done = {key: entry['new'] for key, entry in journal.latest(where=succeeded).items()}
+    for user_id, email in users:
+        new_email = rewrite(email)
+        if new_email and done.get(user_id) != new_email:
+            yield user_id, email, new_email
+
+
+# --------------------------------------------------------------------------------------------------
+def rollback_changes(journal):
+    """
+    Changes restoring the users whose last successful change is a migration, failed attempts in between
+    don't matter so a failed rollback is retried by the next one
+
+    :param journal: journal
+    :type journal: Journal
+    :return: user id, current and previous email
+    :rtype: List[Tuple[str, str, str]]
+    """
+    return [
+        (key, entry['new'], entry['old']) for key, entry in journal.latest(where=succeeded).items()
+        if entry.get('action') == 'migrate'
+    ]
+
+
+# --------------------------------------------------------------------------------------------------
+def run_changes(client, changes, journal, args, action):
+    """
+    Change emails concurrently under the rate limit of users.profile.set, every result is journaled
+
+    :param client: slack client
+    :type client: SlackClient
+    :param changes: user id, current and new email
+    :type changes: Iterable[Tuple[str, str, str]]
+    :param journal: journal
+    :type journal: Journal
+    :param args: command line arguments
+    :type args: Dict
+    :param action: migrate or rollback
+    :type action: str
+    :return: statistics
+    :rtype: Dict
+    """
+    stats = {'changed': 0, 'failed': 0, 'errors': {}}
+    lock = Lock()
+    client.limit('users.profile.set', args.get('rate'), max(1, args.get('concurrency')))
+
+    def run(change):
+        user_id, old, new = change
+        error = change_user_email(client, user_id, new)
+        journal.write(id=user_id, action=action, old=old, new=new, ok=error is None, error=error)
+        with lock:
+            if error is None:
+                stats['changed'] += 1
+                print(f'{old} -> {new}')
+            else:
+                stats['failed'] += 1
+                stats['errors'][error] = stats['errors'].get(error, 0) + 1
+                print(f'{old} -> {new} failed: {error}')
+
+    with ThreadPoolExecutor(max_workers=max(1, args.get('concurrency'))) as executor:
+        # users are submitted while the listing is still paging
+        for future in [executor.submit(run, change) for change in changes]:
+            future.result()
+    return stats
+
+
+# --------------------------------------------------------------------------------------------------
+def verify(client, journal):
+    """
+    Check the emails of the journaled users with a single listing
+
+    :param client: slack client
+    :type client: SlackClient
+    :param journal: journal
+    :type journal: Journal
+    :return: users whose email is not the one of their last successful change, with expected and current email
+    :rtype: Dict
+    """
+    expected = {key: entry['new'] for key, entry in journal.latest(where=succeeded).items()}
+    current = {user_id: email for user_id, email in create_list(client) if user_id in expected}
+    return {
+        user_id: {'expected': email, 'current': current.get(user_id)}
+        for user_id, email in expected.items() if current.get(user_id, '').lower() != email.lower()
+    }
+
+
 # --------------------------------------------------------------------------------------------------
 def main():
-    data = create_list()
-    for user in data:
-        if user[1].endswith('omnigon.com'):
-            new_email = user[1].rstrip('omnigon.com') + 'ix.co'
-            print(f'{user[1]} -> {new_email}') # juss output with no action
-            #change_user_email(user[0], new_email) # uncomment in order to take action
-
- 
- 
+    args = get_arguments()
+    metrics.setup('slack_emails', args)
+    rewrite = compile_rules(args.get('rules'))
+    try:
+        client = SlackClient(args.get('token'), pool_size=max(1, args.get('concurrency')),
+                             retries=args.get('retries'), http2=args.get('http2'))
+    except ImportError as error:
+        print('HTTP/2 needs httpx[http2]: ', error)
+        sys.exit(3)
+    started = monotonic()
+    stats = dict()
+    with client, Journal(args.get('journal')) as journal:
+        try:
+            if args.get('rollback'):
+                stats = run_changes(client, rollback_changes(journal), journal, args, 'rollback')
+            elif args.get('apply'):
+                changes = migration_changes(create_list(client), journal, rewrite)
+                stats = run_changes(client, changes, journal, args, 'migrate')
+            elif not args.get('verify'):
+                for user in create_list(client):
+                    new_email = rewrite(user[1])
+                    if new_email:
+                        print(f'{user[1]} -> {new_email}') # just output with no action
+                return
+            stats['mismatches'] = verify(client, journal)
+        except SlackError as error:
+            print(error)
+            sys.exit(1)
+        stats['calls'] = client.stats
+    stats['seconds'] = round(monotonic() - started, 2)
+    print(dumps(stats))
+    if stats.get('failed') or stats['mismatches']:
+        sys.exit(1)
+
+
+
 if __name__ == '__main__':
     main()
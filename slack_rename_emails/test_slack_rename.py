@@ -0,0 +1,117 @@
+"""
+Journal, resume and rollback of the email migration against an in-memory Slack workspace
+"""
+from contextlib import redirect_stdout
+from io import StringIO
+from json import loads
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+import sys
+sys.path.append(str(Path(__file__).resolve().parent))
+from slack_rename import (  # noqa: E402
+    compile_rules, create_list, migration_changes, rollback_changes, run_changes, verify
+)
+from common.journal import Journal  # noqa: E402
+from common.slack_client import SlackError  # noqa: E402
+
+ARGS = {'rate': 6000, 'concurrency': 2}
+
+
+class FakeClient:
+    """
+    Emails by user id, users.profile.set fails with the queued errors of a user before succeeding
+    """
+
+    def __init__(self, emails):
+        self.emails = dict(emails)
+        self.errors = dict()
+
+    def limit(self, method, per_minute, burst=None):
+        pass
+
+    def paginate(self, method, key, **params):
+        for user_id, email in list(self.emails.items()):
+            yield {'id': user_id, 'profile': {'email': email}}
+
+    def call(self, method, user, profile):
+        if self.errors.get(user):
+            raise SlackError(method, self.errors[user].pop(0))
+        self.emails[user] = loads(profile)['email']
+
+
+class MigrationTest(TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = str(Path(self.directory.name) / 'emails.jsonl')
+        self.client = FakeClient({'U1': 'a@omnigon.com', 'U2': 'b@omnigon.com', 'U3': 'c@other.com'})
+        self.rewrite = compile_rules([('omnigon.com', 'ix.co')])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def migrate(self):
+        with Journal(self.path) as journal, redirect_stdout(StringIO()):
+            changes = migration_changes(create_list(self.client), journal, self.rewrite)
+            return run_changes(self.client, changes, journal, ARGS, 'migrate')
+
+    def rollback(self):
+        with Journal(self.path) as journal, redirect_stdout(StringIO()):
+            return run_changes(self.client, rollback_changes(journal), journal, ARGS, 'rollback')
+
+    def mismatches(self):
+        with Journal(self.path) as journal:
+            return verify(self.client, journal)
+
+    def test_migrate_journals_every_result(self):
+        self.client.errors['U2'] = ['ratelimited']
+        stats = self.migrate()
+        self.assertEqual((stats['changed'], stats['failed']), (1, 1))
+        with Journal(self.path) as journal:
+            latest = journal.latest()
+        self.assertTrue(latest['U1']['ok'])
+        self.assertEqual(latest['U2']['error'], 'ratelimited')
+        self.assertNotIn('U3', latest)
+
+    def test_resume_changes_only_the_rest(self):
+        self.client.errors['U2'] = ['ratelimited']
+        self.migrate()
+        stats = self.migrate()
+        self.assertEqual((stats['changed'], stats['failed']), (1, 0))
+        self.assertEqual(self.client.emails, {'U1': 'a@ix.co', 'U2': 'b@ix.co', 'U3': 'c@other.com'})
+        self.assertEqual(self.mismatches(), {})
+
+    def test_rollback_restores_migrated_users(self):
+        self.migrate()
+        stats = self.rollback()
+        self.assertEqual(stats['changed'], 2)
+        self.assertEqual(self.client.emails, {'U1': 'a@omnigon.com', 'U2': 'b@omnigon.com', 'U3': 'c@other.com'})
+        self.assertEqual(self.mismatches(), {})
+        self.assertEqual(self.rollback()['changed'], 0)
+
+    def test_failed_rollback_is_retried(self):
+        self.migrate()
+        self.client.errors['U1'] = ['ratelimited']
+        self.assertEqual(self.rollback()['failed'], 1)
+        # the last successful change of U1 is still the migration, verify expects the new email
+        self.assertEqual(self.mismatches(), {})
+        stats = self.rollback()
+        self.assertEqual((stats['changed'], stats['failed']), (1, 0))
+        self.assertEqual(self.client.emails['U1'], 'a@omnigon.com')
+        self.assertEqual(self.mismatches(), {})
+
+    def test_verify_reports_changed_emails(self):
+        self.migrate()
+        self.client.emails['U1'] = 'a@elsewhere.com'
+        self.assertEqual(self.mismatches(), {'U1': {'expected': 'a@ix.co', 'current': 'a@elsewhere.com'}})
+
+    def test_migrate_again_after_rollback(self):
+        self.migrate()
+        self.rollback()
+        self.assertEqual(self.migrate()['changed'], 2)
+        self.assertEqual(self.client.emails['U2'], 'b@ix.co')
+
+
+if __name__ == '__main__':
+    main()
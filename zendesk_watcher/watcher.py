@@ -5,81 +5,649 @@ Slack alerting for SLA breaching tickets
 """
 from datetime import datetime, timedelta, timezone
 import os
-from json import dumps
-from argparse import ArgumentParser
+from json import dumps, loads
+from argparse import ArgumentParser, ArgumentTypeError
 from logging import getLogger, basicConfig, INFO
-from requests import post
-from requests.exceptions import Timeout, TooManyRedirects, RequestException
-from zenpy import Zenpy
+from pathlib import Path
+from queue import Queue
+from sys import path as sys_path
+from threading import Thread
+from urllib.parse import urlparse
+from time import monotonic
+sys_path.append(str(Path(__file__).resolve().parents[1]))
+from common import metrics  # noqa: E402
+from common.metrics import METRICS  # noqa: E402
+from common.rate_limit import TokenBucket, retry_after  # noqa: E402
 basicConfig(level=INFO, format='%(asctime)s %(levelname)12s: %(message)s')
 LOG = getLogger('slack-notify')
 PICTURE = "https://i2.wp.com/4inim.ru/wp-content/uploads/2018/09/attention.png"
+ZD_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+THRESHOLDS = {'sev_1': timedelta(hours=2), 'sev_2': timedelta(days=1)}
+OPEN_STATUSES = ('new', 'open')
+# zendesk search indexes updates with a delay, changes are fetched again from this long before the cursor
+SEARCH_LAG = timedelta(minutes=15)
+# slack renders up to 3000 characters of an attachment text without folding and at most 100 attachments,
+# a message is kept well below its 40000 characters limit
+ATTACHMENT_CHARS = 3000
+MESSAGE_ATTACHMENTS = 10
+DIGEST_LINKS = 25
+# reference of the digest lines, counted as sent once slack accepts one of its messages
+DIGEST = 'digest'
+# organizations per show_many request, the API maximum
+ORG_BATCH = 100
+# requests and zenpy take about 0.1 s to import, they are imported where they are first used so that
+# argument errors, --help and the module import in other tools and benchmarks don't load them
 
 
-def send_message_to_slack(text, cfg):
+def get_arguments():
     """
-    Send message to slack channel
+    Parse call arguments
 
-    :param text: text to send
-    :type text: str
-    :param cfg: config dict
-    :type cfg: Dict
+    :return: arguments
+    :rtype: Dict
+    """
+    parser = ArgumentParser()
+    parser.add_argument('-s', '--state', dest='state', type=str, default=None,
+                        help='ticket index file, fetch only tickets updated since the previous run')
+    parser.add_argument('-T', '--threshold', dest='thresholds', type=parse_threshold, action='append',
+                        help='time without update allowed for a severity, like sev_1=2h, repeat for every severity '
+                             'watched, default sev_1=2h and sev_2=1d')
+    parser.add_argument('-a', '--alerts', dest='alerts', type=str, default=None,
+                        help='store of announced breaches, only new, updated or escalated breaches are sent')
+    parser.add_argument('--alert-ttl', dest='alert_ttl', type=parse_duration, default=timedelta(days=1),
+                        help='announce a still breaching ticket again after this long, default 1d')
+    parser.add_argument('--digest', dest='digest', type=parse_duration, default=None,
+                        help='with --alerts, send a digest of the breaches already announced at most this often')
+    parser.add_argument('-o', '--org-cache', dest='org_cache', type=str, default=None,
+                        help='file keeping organization names between runs')
+    parser.add_argument('--org-ttl', dest='org_ttl', type=parse_duration, default=timedelta(days=1),
+                        help='fetch cached organization names again after this long, default 1d')
+    parser.add_argument('--slack-rate', dest='slack_rate', type=float, default=1.0,
+                        help='webhook messages per second, slack allows about one')
+    parser.add_argument('--slack-burst', dest='slack_burst', type=parse_burst, default=3,
+                        help='webhook messages sent at once before the rate applies')
+    metrics.add_arguments(parser)
+    args = vars(parser.parse_args())
+    args['thresholds'] = dict(args.get('thresholds') or THRESHOLDS)
+    return args
+
+
+def load_json(path, default):
+    """
+    Read json state file
+
+    :param path: path to file
+    :type path: str
+    :param default: value when the file does not exist or is broken
+    :type default: Any
+    :return: file content
+    :rtype: Any
     """
-    json_data = dumps(
-        {
-            'username': 'SLA Watcher',
-            'attachments': [
-                {
-                    'fallback': 'High-Sev',
-                    'color': '#ba0d1e',
-                    'text': f'{text}',
-                    'thumb_url': PICTURE
-                }
-            ]
-        }
-    )
     try:
-        LOG.info("Sent message to tcss: %s", text)
-        response = post(
-            cfg['webhook'],
-            data=json_data.encode('utf-8'),
-            headers={'Content-Type': 'application/json'}
+        with open(path) as state_file:
+            return loads(state_file.read())
+    except FileNotFoundError:
+        return default
+    except ValueError as err:
+        LOG.error('Ignoring broken state file %s: %s', path, err)
+        return default
+
+
+def save_json(path, data):
+    """
+    Replace json state file atomically
+
+    :param path: path to file
+    :type path: str
+    :param data: file content
+    :type data: Any
+    """
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as state_file:
+        state_file.write(dumps(data))
+    os.replace(temporary, path)
+
+
+class SlackNotifier:
+    """
+    Packs alert lines into few webhook messages and sends them from a background thread
+    over one pooled session, so sending overlaps with the ticket scan. The references of the lines
+    of every message slack accepted are collected in delivered
+
+    :param webhook: slack incoming webhook url
+    :type webhook: str
+    :param rate: messages per second
+    :type rate: float
+    :param burst: messages sent at once before the rate applies
+    :type burst: int
+    :param retries: attempts after a 429, 5xx or connection error
+    :type retries: int
+    :param timeout: seconds per request
+    :type timeout: float
+    """
+
+    def __init__(self, webhook, rate=1.0, burst=3, retries=3, timeout=30):
+        from requests import Session
+        self.webhook = webhook
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.timeout = timeout
+        self.session = Session()
+        self.queue = Queue()
+        self.pending = dict()
+        self.sent = 0
+        self.failed = 0
+        self.delivered = set()
+        self.thread = Thread(target=self.run, name='slack-notifier', daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, key, header, line, ref=None):
+        """
+        Queue a line under a header, lines of the same key are packed into one message up to the size limits
+
+        :param key: group of lines, e.g. severity
+        :type key: str
+        :param header: first attachment of every message of the group
+        :type header: str
+        :param line: alert line, cut to the size of an attachment
+        :type line: str
+        :param ref: reference added to delivered once the message carrying the line is accepted, e.g. ticket id
+        :type ref: str
+        """
+        if len(line) > ATTACHMENT_CHARS:
+            line = line[:ATTACHMENT_CHARS - 1] + '…'
+        message = self.pending.get(key)
+        if message is None:
+            message = self.pending[key] = {'header': header, 'attachments': [''], 'refs': set(), 'parts': 0}
+        text = message['attachments'][-1]
+        if text and len(text) + len(line) + 1 > ATTACHMENT_CHARS:
+            if len(message['attachments']) == MESSAGE_ATTACHMENTS:
+                self.flush(key)
+                self.add(key, header, line, ref)
+                return
+            message['attachments'].append('')
+            text = ''
+        message['attachments'][-1] = f'{text}\n{line}' if text else line
+        if ref is not None:
+            message['refs'].add(ref)
+
+    def flush(self, key=None):
+        """
+        Hand packed messages to the sending thread
+
+        :param key: group to flush, all groups when None
+        :type key: str
+        """
+        for name in [key] if key is not None else list(self.pending):
+            message = self.pending.get(name)
+            if message is None or not any(message['attachments']):
+                continue
+            header = message['header']
+            if message['parts']:
+                header = f'{header} (continued)'
+            self.queue.put(([header] + message['attachments'], message['refs']))
+            self.pending[name] = dict(message, attachments=[''], refs=set(), parts=message['parts'] + 1)
+
+    def send(self, text, ref=None):
+        """
+        Queue a standalone message
+
+        :param text: text to send
+        :type text: str
+        :param ref: reference added to delivered once the message is accepted
+        :type ref: str
+        """
+        self.queue.put(([text], {ref} if ref is not None else set()))
+
+    def close(self):
+        """
+        Send what is left and wait for the sending thread
+        """
+        self.flush()
+        self.queue.put(None)
+        if self.thread.is_alive():
+            self.thread.join()
+        self.session.close()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            texts, refs = item
+            if self.post(texts):
+                self.sent += 1
+                self.delivered.update(refs)
+            else:
+                self.failed += 1
+
+    def post(self, texts):
+        """
+        Send message to slack channel
+
+        :param texts: attachment texts
+        :type texts: List[str]
+        :return: True when slack accepted the message
+        :rtype: bool
+        """
+        from requests.exceptions import Timeout, TooManyRedirects, RequestException
+        json_data = dumps(
+            {
+                'username': 'SLA Watcher',
+                'attachments': [
+                    {
+                        'fallback': 'High-Sev',
+                        'color': '#ba0d1e',
+                        'text': f'{text}',
+                        'thumb_url': PICTURE
+                    }
+                    for text in texts
+                ]
+            }
+        ).encode('utf-8')
+        started = monotonic()
+        attempt = 0
+        outcome = 'error'
+        try:
+            for attempt in range(self.retries + 1):
+                self.bucket.acquire()
+                try:
+                    response = self.session.post(
+                        self.webhook,
+                        data=json_data,
+                        headers={'Content-Type': 'application/json'},
+                        timeout=self.timeout
+                    )
+                except Timeout:
+                    LOG.error('Request timed out')
+                    continue
+                except TooManyRedirects:
+                    LOG.error('Request failed with too many redirects')
+                    return False
+                except RequestException as err:
+                    LOG.error('Request failed: %s', err)
+                    continue
+                if response.status_code == 200:
+                    LOG.info("Sent message to tcss: %s", texts[0])
+                    outcome = 'ok'
+                    return True
+                if response.status_code != 429 and response.status_code < 500:
+                    LOG.error(
+                        'Request to slack returned an error %s, the response is:\n%s',
+                        response.status_code, response.text
+                    )
+                    return False
+                delay = retry_after(response, 2 ** attempt)
+                LOG.error('Request to slack returned %s, retrying in %s seconds', response.status_code, delay)
+                self.bucket.pause(delay)
+            return False
+        finally:
+            METRICS.call('slack.webhook', monotonic() - started, outcome, attempt, len(json_data))
+
+
+class TicketRecord:
+    """
+    Ticket fields the watcher needs, extracted once per ticket
+    """
+    __slots__ = ('id', 'subject', 'organization_id', 'org_name', 'severity', 'updated_at', 'updated',
+                 'created_at', 'url')
+    FIELDS = ('id', 'subject', 'organization_id', 'org_name', 'severity', 'updated_at', 'created_at', 'url')
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields.get(name))
+        self.updated = parse_time(self.updated_at)
+
+    @classmethod
+    def from_ticket(cls, ticket, sev_field_id):
+        """
+        Project a zenpy ticket, the organization name is resolved later and only when needed
+
+        :param ticket: ticket
+        :type ticket: Ticket
+        :param sev_field_id: id of the severity custom field
+        :type sev_field_id: int
+        :return: record
+        :rtype: TicketRecord
+        """
+        severity = None
+        for field in ticket.custom_fields:
+            if field['id'] == sev_field_id:
+                severity = field['value']
+                break
+        return cls(
+            id=ticket.id,
+            subject=ticket.subject,
+            organization_id=ticket.organization_id,
+            severity=severity,
+            updated_at=ticket.updated_at,
+            created_at=ticket.created_at,
+            url=ticket.url
+        )
+
+    def entry(self):
+        """
+        Fields kept in the ticket index
+
+        :return: index entry
+        :rtype: Dict
+        """
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def line(self):
+        """
+        Form text line with ticket info
+
+        :return: String to send
+        :rtype: str
+        """
+        return ' | '.join(
+            [
+                str(self.id),
+                self.subject,
+                self.org_name or 'Unknown org',
+                f"Updated: {self.updated_at}",
+                f"Severity: {self.severity}",
+                f"Link: {zd_link(self.url)}"
+            ]
         )
-        if response.status_code != 200:
-            raise ValueError(
-                f'Request to slack returned an error {response.status_code},'
-                + f'the response is:\n{response.text}'
-            )
-    except Timeout:
-        LOG.error('Request timed out')
-    except TooManyRedirects:
-        LOG.error('Request failed with too many redirects')
-    except RequestException as err:
-        LOG.error('Request failed: %s', err)
 
 
-def sla_breach(ticket, cfg):
+def parse_time(value):
     """
-    Determine if ticket breach SLA
+    Parse zendesk UTC timestamp
 
-    :param ticket: ticket dict
-    :type ticket: Dict
-    :param cfg: parameters dict
-    :type cfg: Dict
-    :return: breach type
+    :param value: timestamp like 2020-01-31T12:00:00Z
+    :type value: str
+    :return: naive UTC datetime
+    :rtype: datetime
+    """
+    return datetime.fromisoformat(value[:-1] if value.endswith('Z') else value)
+
+
+def parse_duration(value):
+    """
+    Parse duration in seconds or with an s, m, h or d suffix
+
+    :param value: duration like 90m
+    :type value: str
+    :return: duration
+    :rtype: timedelta
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    try:
+        if value[-1:] in units:
+            return timedelta(seconds=float(value[:-1]) * units[value[-1]])
+        return timedelta(seconds=float(value))
+    except ValueError as err:
+        raise ArgumentTypeError(f'invalid duration {value}, expected like 90m, 2h or 1d') from err
+
+
+def parse_burst(value):
+    """
+    Parse the number of webhook messages sent at once, at least one or no message could ever be sent
+
+    :param value: burst like 3
+    :type value: str
+    :return: burst
     :rtype: int
     """
-    status: int = 0
-    severity = list(filter(
-        lambda field: field['id'] == cfg['sev_field_id'],
-        ticket.custom_fields
-    ))[0]['value']
-    last_update = datetime.strptime(ticket.updated_at, '%Y-%m-%dT%H:%M:%SZ')
-    if (severity == 'sev_1') and (last_update <= cfg['two_hours_ago']):
-        status = 1
-    elif (severity == 'sev_2') and (last_update <= cfg['day_ago']):
-        status = 2
-    return status
+    try:
+        burst = int(value)
+    except ValueError as err:
+        raise ArgumentTypeError(f'invalid burst {value}, expected a whole number') from err
+    if burst < 1:
+        raise ArgumentTypeError(f'invalid burst {value}, at least 1 message has to fit')
+    return burst
+
+
+def parse_threshold(value):
+    """
+    Parse severity=duration
+
+    :param value: threshold like sev_1=2h
+    :type value: str
+    :return: severity and duration
+    :rtype: Tuple[str, timedelta]
+    """
+    severity, _, duration = value.partition('=')
+    if not severity or not duration:
+        raise ArgumentTypeError(f'invalid threshold {value}, expected like sev_1=2h')
+    return severity, parse_duration(duration)
+
+
+def describe(delta, article=False):
+    """
+    Human readable duration
+
+    :param delta: duration
+    :type delta: timedelta
+    :param article: 'a day' instead of '1 day'
+    :type article: bool
+    :return: description
+    :rtype: str
+    """
+    seconds = int(delta.total_seconds())
+    for unit, size in (('day', 86400), ('hour', 3600), ('minute', 60)):
+        if seconds >= size and seconds % size == 0:
+            count = seconds // size
+            if count == 1:
+                return f"{'an' if unit == 'hour' else 'a'} {unit}" if article else f'1 {unit}'
+            return f'{count} {unit}s'
+    return f'{seconds} seconds'
+
+
+def severity_label(severity):
+    """
+    Label of a severity field value, sev_1 is SEV-1
+
+    :param severity: severity field value
+    :type severity: str
+    :return: label
+    :rtype: str
+    """
+    return severity.upper().replace('_', '-')
+
+
+def find_breaches(records, thresholds, now, on_breach=None):
+    """
+    Evaluate the SLA thresholds over a batch of records in one pass
+
+    :param records: ticket records
+    :type records: Iterable[TicketRecord]
+    :param thresholds: time without update allowed by severity
+    :type thresholds: Dict[str, timedelta]
+    :param now: current naive UTC time
+    :type now: datetime
+    :param on_breach: called with every breaching record as soon as it is found
+    :type on_breach: Callable
+    :return: breaching records by severity, in threshold order
+    :rtype: Dict[str, List[TicketRecord]]
+    """
+    cutoffs = {severity: now - delta for severity, delta in thresholds.items()}
+    breaches = {severity: list() for severity in thresholds}
+    for record in records:
+        cutoff = cutoffs.get(record.severity)
+        if cutoff is not None and record.updated <= cutoff:
+            breaches[record.severity].append(record)
+            if on_breach is not None:
+                on_breach(record)
+    return breaches
+
+
+class OrgCache:
+    """
+    Organization names by id, fetched in bulk and optionally kept on disk between runs
+
+    :param zenpy_client: zendesk client
+    :type zenpy_client: Zenpy
+    :param path: path to the json cache, None keeps it in memory only
+    :type path: str
+    :param ttl: names are fetched again after this long
+    :type ttl: timedelta
+    :param now: current naive UTC time
+    :type now: datetime
+    """
+
+    def __init__(self, zenpy_client, path=None, ttl=timedelta(days=1), now=None):
+        self.zenpy_client = zenpy_client
+        self.path = path
+        self.now = (now or datetime.utcnow()).strftime(ZD_TIME_FORMAT)
+        expired = ((now or datetime.utcnow()) - ttl).strftime(ZD_TIME_FORMAT)
+        saved = load_json(path, {}) if path else {}
+        self.names = {key: entry for key, entry in saved.items() if entry[1] > expired}
+        self.requests = 0
+
+    def missing(self, records):
+        """
+        Organization ids of the records that are not cached
+
+        :param records: ticket records
+        :type records: Iterable[TicketRecord]
+        :return: organization ids
+        :rtype: Set[int]
+        """
+        return {
+            record.organization_id for record in records
+            if record.org_name is None and record.organization_id and str(record.organization_id) not in self.names
+        }
+
+    def resolve(self, records):
+        """
+        Fill in organization names of records that don't have one yet, fetching the missing ones
+        with one show_many request per ORG_BATCH organizations
+
+        :param records: ticket records
+        :type records: List[TicketRecord]
+        """
+        ids = sorted(self.missing(records))
+        for first in range(0, len(ids), ORG_BATCH):
+            self.requests += 1
+            for organization in self.zenpy_client.organizations(ids=ids[first:first + ORG_BATCH]):
+                self.names[str(organization.id)] = [organization.name, self.now]
+        for record in records:
+            if record.org_name is None and record.organization_id:
+                entry = self.names.get(str(record.organization_id))
+                record.org_name = entry[0] if entry else None
+
+    def save(self):
+        """
+        Write the cache when it is kept on disk
+        """
+        if self.path:
+            save_json(self.path, self.names)
+
+
+class AlertStore:
+    """
+    Breaches already announced, keyed by ticket id with the breach level and updated_at they were sent for.
+    A breach is only recorded once the message announcing it was delivered, see confirm
+
+    :param path: path to the json store
+    :type path: str
+    :param ttl: announced breaches are announced again after this long
+    :type ttl: timedelta
+    :param now: current naive UTC time
+    :type now: datetime
+    :param thresholds: time without update allowed by severity, a shorter time is a higher severity
+    :type thresholds: Dict[str, timedelta]
+    """
+
+    def __init__(self, path, ttl, now, thresholds):
+        self.path = path
+        self.now = now
+        self.thresholds = thresholds
+        # the first digest is due one interval after the store is created
+        self.data = load_json(path, {'alerts': {}, 'digest_sent': now.strftime(ZD_TIME_FORMAT)})
+        expired = (now - ttl).strftime(ZD_TIME_FORMAT)
+        self.alerts = {key: alert for key, alert in self.data['alerts'].items() if alert['sent'] > expired}
+        self.seen = set()
+        # breaches to announce, recorded once their message is delivered
+        self.candidates = dict()
+
+    def rank(self, severity):
+        """
+        Threshold of a severity, the shorter the higher the severity, unknown severities rank lowest
+
+        :param severity: severity field value
+        :type severity: str
+        :return: time without update allowed
+        :rtype: timedelta
+        """
+        return self.thresholds.get(severity, timedelta.max)
+
+    def is_new(self, record):
+        """
+        True for a breach not announced yet, a ticket updated since or escalated to a higher severity
+
+        :param record: breaching ticket
+        :type record: TicketRecord
+        :return: whether to announce the breach
+        :rtype: bool
+        """
+        key = str(record.id)
+        self.seen.add(key)
+        alert = self.alerts.get(key)
+        if (alert is None or alert['updated_at'] != record.updated_at
+                or self.rank(record.severity) < self.rank(alert['level'])):
+            self.candidates[key] = {'level': record.severity, 'updated_at': record.updated_at,
+                                    'sent': self.now.strftime(ZD_TIME_FORMAT)}
+            return True
+        # a lowered severity is kept so that escalating again is announced
+        alert['level'] = record.severity
+        return False
+
+    def digest_due(self, interval):
+        """
+        Whether a digest of the breaches already announced is due
+
+        :param interval: time between digests
+        :type interval: timedelta
+        :return: True when due
+        :rtype: bool
+        """
+        last = self.data.get('digest_sent')
+        return not last or datetime.strptime(last, ZD_TIME_FORMAT) <= self.now - interval
+
+    def confirm(self, delivered):
+        """
+        Record the breaches and the digest whose messages were delivered
+
+        :param delivered: ticket ids and DIGEST of the lines slack accepted
+        :type delivered: Set[str]
+        """
+        for key in delivered & self.candidates.keys():
+            self.alerts[key] = self.candidates.pop(key)
+        if DIGEST in delivered:
+            self.data['digest_sent'] = self.now.strftime(ZD_TIME_FORMAT)
+
+    def save(self):
+        """
+        Forget tickets that stopped breaching and write the store
+        """
+        self.data['alerts'] = {key: alert for key, alert in self.alerts.items() if key in self.seen}
+        save_json(self.path, self.data)
+
+
+def record_zendesk_call(response, *args, **kwargs):
+    """
+    Response hook of the zenpy session, records every zendesk API call in the metrics
+
+    :param response: zendesk response
+    :type response: Response
+    """
+    parts = urlparse(response.url).path.split('/')
+    name = parts[3].split('.')[0] if len(parts) > 3 else 'api'
+    METRICS.call(
+        f'zendesk.{name}', response.elapsed.total_seconds(), 'ok' if response.ok else f'HTTP {response.status_code}',
+        sent=len(response.request.body or b''), received=len(response.content)
+    )
 
 
 def zd_link(zd_url):
@@ -92,56 +660,87 @@ def zd_link(zd_url):
     return (zd_url.replace("api/v2/tickets", "hc/requests")).replace(".json", "")
 
 
-def ticket_line(ticket, cfg):
+def update_index(zenpy_client, index, search_criteria, cfg, orgs):
     """
-    Form text line with ticket info
+    Bring the index of open high severity tickets up to date, from a full search export on the first run
+    and from the incremental ticket export afterwards. The export has no result cap and is read in pages
+    of tickets by update time, the cursor of the index is advanced after every page
 
-    :param ticket: ticket dict
-    :type ticket: Dict
+    :param zenpy_client: zendesk client
+    :type zenpy_client: Zenpy
+    :param index: ticket index with export cursor and tickets by id
+    :type index: Dict
+    :param search_criteria: search of the open tickets of the group
+    :type search_criteria: Dict
     :param cfg: parameters dict
     :type cfg: Dict
-    :return: String to send
-    :rtype: str
+    :param orgs: organization names
+    :type orgs: OrgCache
+    :return: number of tickets fetched
+    :rtype: int
     """
-    severity = list(filter(
-        lambda field: field['id'] == cfg['sev_field_id'],
-        ticket.custom_fields
-    ))[0]['value']
-    org_name = 'Unknown org'
-    if ticket.organization:
-        org_name = ticket.organization.name
-    line = ' | '.join(
-        [
-            str(ticket.id),
-            ticket.subject,
-            org_name,
-            f"Updated: {ticket.updated_at}",
-            f"Severity: {severity}",
-            f"Link: {zd_link(ticket.url)}"
-        ]
-    )
-    return line
+    tickets = index['tickets']
+    fetched = 0
+
+    def apply(page):
+        changed = list()
+        for ticket in page:
+            tickets.pop(str(ticket.id), None)
+            # the export holds every ticket, closed ones and the ones of other groups included
+            if ticket.status in OPEN_STATUSES and str(ticket.group_id) == search_criteria['group_id']:
+                record = TicketRecord.from_ticket(ticket, cfg['sev_field_id'])
+                if record.severity in cfg['thresholds']:
+                    changed.append(record)
+        orgs.resolve(changed)
+        for record in changed:
+            tickets[str(record.id)] = record.entry()
+        return len(page)
+
+    if index.get('after_cursor'):
+        export = zenpy_client.tickets.incremental(cursor=index['after_cursor'])
+    elif index.get('cursor'):
+        # index of an earlier version, resumed from the last updated_at it saw
+        since = datetime.strptime(index['cursor'], ZD_TIME_FORMAT) - SEARCH_LAG
+        export = zenpy_client.tickets.incremental(start_time=since.replace(tzinfo=timezone.utc))
+    else:
+        tickets.clear()
+        started = datetime.now(timezone.utc)
+        # search export pages by cursor without the 1000 results cap of search, and takes no sort
+        criteria = {key: value for key, value in search_criteria.items() if key not in ('sort_by', 'sort_order')}
+        fetched += apply(list(zenpy_client.search_export(**criteria)))
+        # changes made while the search was paging, or not indexed by the search yet, come from the export
+        export = zenpy_client.tickets.incremental(start_time=started - SEARCH_LAG)
+    page = list()
+    page_cursor = getattr(export, 'after_cursor', None)
+    for ticket in export:
+        if export.after_cursor != page_cursor:
+            # the generator fetched the next page, the previous one is complete
+            fetched += apply(page)
+            index['after_cursor'] = page_cursor
+            page, page_cursor = list(), export.after_cursor
+        page.append(ticket)
+    fetched += apply(page)
+    # an empty last page moves the cursor too
+    index['after_cursor'] = getattr(export, 'after_cursor', None) or index.get('after_cursor')
+    index.pop('cursor', None)
+    return fetched
 
 
 def main():
     """
     Main function
     """
+    args = get_arguments()
+    metrics.setup('watcher', args)
     cfg = {
-        'two_hours_ago': (
-                datetime.now(timezone.utc) - timedelta(hours=2)
-        ).replace(tzinfo=None, microsecond=0),
-        'day_ago': (
-                datetime.now(timezone.utc) - timedelta(days=1)
-        ).replace(tzinfo=None, microsecond=0),
+        'thresholds': args.get('thresholds'),
         'email': os.environ.get('ZD_EMAIL'),
         'token': os.environ.get('ZD_TOKEN'),
         'webhook': os.environ.get('SLACK_WEBHOOK'),
         'subdomain': 'thisisix',
         'sev_field_id': 58614488
     }
-    sev_1_list = []
-    sev_2_list = []
+    now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
     credentials = {
         'email': cfg['email'],
         'token': cfg['token'],
@@ -154,33 +753,79 @@ def main():
         'sort_order': 'desc',
         'group_id': '360015150233'
     }
-    zenpy_client = Zenpy(**credentials)
-    search_result = zenpy_client.search(**search_criteria)
-    if search_result:
-        for ticket in search_result:
-            if high_sev := sla_breach(ticket, cfg):
-                if high_sev == 1:
-                    sev_1_list.append(ticket_line(ticket, cfg))
-                elif high_sev == 2:
-                    sev_2_list.append(ticket_line(ticket, cfg))
-    if sev_1_list:
-        LOG.info('%s SEV-1 tickets breached 2 hours SLA', len(sev_1_list))
-        send_message_to_slack(
-            "The list of open *SEV-1* incidents that have not been updated for 2 hours:",
-            cfg
-        )
-        for i in sev_1_list:
-            send_message_to_slack(i, cfg)
-    if sev_2_list:
-        LOG.info('%s SEV-2 tickets breached 1 day SLA', len(sev_2_list))
-        send_message_to_slack(
-            "The list of open *SEV-2* incidents that have not been updated for a day:",
-            cfg
-        )
-        for i in sev_2_list:
-            send_message_to_slack(i, cfg)
-    if not (sev_1_list or sev_2_list):
+    from requests import Session
+    from zenpy import Zenpy
+    zendesk_session = Session()
+    zendesk_session.hooks['response'].append(record_zendesk_call)
+    zenpy_client = Zenpy(session=zendesk_session, **credentials)
+    headers = {
+        severity: f"The list of open *{severity_label(severity)}* incidents that have not been updated for "
+                  f"{describe(delta, article=True)}:"
+        for severity, delta in cfg['thresholds'].items()
+    }
+
+    alerts = None
+    if args.get('alerts'):
+        alerts = AlertStore(args.get('alerts'), args.get('alert_ttl'), now, cfg['thresholds'])
+    orgs = OrgCache(zenpy_client, args.get('org_cache'), args.get('org_ttl'), now)
+    known = {severity: list() for severity in cfg['thresholds']}
+    pending = list()
+
+    def send_pending():
+        orgs.resolve(pending)
+        for record in pending:
+            notifier.add(record.severity, headers[record.severity], record.line(), str(record.id))
+        pending.clear()
+
+    def announce(record):
+        if alerts is not None and not alerts.is_new(record):
+            known[record.severity].append(record)
+            return
+        pending.append(record)
+        # lines wait until a whole show_many request of unknown organizations is gathered
+        if len(orgs.missing(pending)) >= ORG_BATCH:
+            send_pending()
+
+    with SlackNotifier(cfg['webhook'], args.get('slack_rate'), args.get('slack_burst')) as notifier:
+        if args.get('state'):
+            index = load_json(args.get('state'), {'after_cursor': None, 'tickets': {}})
+            with METRICS.phase('update_index'):
+                fetched = update_index(zenpy_client, index, search_criteria, cfg, orgs)
+            save_json(args.get('state'), index)
+            LOG.info('%s tickets fetched, %s open high severity tickets indexed', fetched, len(index['tickets']))
+            entries = sorted(index['tickets'].values(), key=lambda entry: entry['created_at'], reverse=True)
+            records = (TicketRecord(**entry) for entry in entries)
+        else:
+            search_result = zenpy_client.search(**search_criteria)
+            records = (TicketRecord.from_ticket(ticket, cfg['sev_field_id']) for ticket in search_result or [])
+        # lines are packed and sent while the search is still paging
+        with METRICS.phase('scan'):
+            breaches = find_breaches(records, cfg['thresholds'], now, announce)
+            send_pending()
+        orgs.save()
+        LOG.info('%s organization requests', orgs.requests)
+        for severity, breaching in breaches.items():
+            if breaching:
+                LOG.info('%s %s tickets breached %s SLA, %s announced before', len(breaching),
+                         severity_label(severity), describe(cfg['thresholds'][severity]), len(known[severity]))
+        if alerts is not None and args.get('digest') and any(known.values()) and alerts.digest_due(args.get('digest')):
+            header = 'Open incidents announced before and still breaching SLA:'
+            for severity, announced in known.items():
+                if announced:
+                    notifier.add(DIGEST, header, f"*{severity_label(severity)}*: {len(announced)} tickets", DIGEST)
+                for first in range(0, len(announced), DIGEST_LINKS):
+                    notifier.add(DIGEST, header, ', '.join(
+                        f'<{zd_link(record.url)}|{record.id}>' for record in announced[first:first + DIGEST_LINKS]
+                    ), DIGEST)
+    # the store is written once every message was sent or given up, with the delivered breaches only
+    if alerts is not None:
+        alerts.confirm(notifier.delivered)
+        alerts.save()
+    LOG.info('%s slack messages sent, %s failed', notifier.sent, notifier.failed)
+    if not any(breaches.values()):
         LOG.info("There are currently no open High-Severity tickets breaching SLA for updates")
+    for severity, breaching in breaches.items():
+        METRICS.count('breaches_total', len(breaching), severity=severity)
 
 
 if __name__ == "__main__":